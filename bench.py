@@ -0,0 +1,456 @@
+"""
+micro benchmarks for bsmdoc, e.g.,
+    $ python bench.py           # run all benchmarks
+    $ python bench.py parser    # run bench_parser() only
+"""
+import io
+import os
+import sys
+import contextlib
+import time
+import timeit
+import shutil
+import subprocess
+import tempfile
+from bsmdoc import BParse, BDoc, BWatch, BFunction, highlight_cache
+from bsmdoc import bsmdoc as _bsmdoc
+
+
+def _report(name, seconds, number=1, unit='ms'):
+    scale = {'s': 1, 'ms': 1e3, 'us': 1e6}[unit]
+    print('%-40s %10.3f %s' % (name, seconds / number * scale, unit))
+
+
+def bench_parser():
+    """BParse construction time"""
+    cache = tempfile.mkdtemp()
+    os.environ['BSMDOC_CACHE_DIR'] = cache
+    try:
+        def cold():
+            # no table in memory or on disk, i.e., the tables are generated
+            # for each instance
+            BParse._tables.clear()
+            shutil.rmtree(cache, ignore_errors=True)
+            BParse(False)
+
+        def disk():
+            # the tables are loaded from the disk cache (e.g., a new process)
+            BParse._tables.clear()
+            BParse(False)
+
+        n = 10
+        _report('BParse() regenerate tables', timeit.timeit(cold, number=n), n)
+        _report('BParse() load tables from disk', timeit.timeit(disk, number=n), n)
+        BParse(False)
+        n = 200
+        _report('BParse() shared tables', timeit.timeit(lambda: BParse(False), number=n), n)
+    finally:
+        del os.environ['BSMDOC_CACHE_DIR']
+        shutil.rmtree(cache, ignore_errors=True)
+
+
+def _synthetic(lines):
+    """generate a synthetic doc with short paragraphs and tables"""
+    doc = ['= heading \\label{anchor}']
+    while len(doc) < lines:
+        doc += ['word in a paragraph \\tag{b|bold} [#anchor|link]'] * 4 + ['']
+        doc += ['{{'] + ['cell | \\tag{b|value} ||-'] * 20 + ['}}']
+    return '\n'.join(doc) + '\n'
+
+
+def bench_scaling():
+    """parse time of the synthetic doc with 1k~200k lines"""
+    for lines in [1000, 10000, 50000, 100000, 200000]:
+        txt = _synthetic(lines)
+        doc = BDoc()
+        seconds = timeit.timeit(lambda: doc.parse_string(txt), number=1)
+        _report('%6d lines (%.1f us/line)' % (lines, seconds / lines * 1e6), seconds, unit='s')
+
+
+def bench_config():
+    """config-heavy doc: numbered headings, labels, captions and references"""
+    doc = ['\\config{heading_numbering|True}', '\\config{image_numbering|True}',
+           '\\config{table_numbering|True}']
+    for i in range(500):
+        doc += ['== section %d \\label{sec-%d}' % (i, i),
+                'see \\ref{sec-%d}, \\ref{img-%d} and [#tbl-%d|table]' % (i, i, i),
+                '{!image||', '\\caption{figure %d}' % i, '\\label{img-%d}' % i, 'a.png', '!}',
+                '{{', '\\caption{table %d}' % i, '\\label{tbl-%d}' % i, ' a | b ||-', '}}']
+    txt = '\n'.join(doc) + '\n'
+    cfg = BParse(False).config
+    cfg.reset_options()
+    cfg['ANCHOR:sec-1'] = '1.1'
+    n = 100000
+    _report('cfg[\'heading_numbering\']',
+            timeit.timeit(lambda: cfg['heading_numbering'], number=n), n, 'us')
+    _report('cfg[\'ANCHOR:sec-1\']', timeit.timeit(lambda: cfg['ANCHOR:sec-1'], number=n), n, 'us')
+    _report('cfg[\'doctitle\'] (interpolation)',
+            timeit.timeit(lambda: cfg['doctitle'], number=n), n, 'us')
+    _report('cfg[\'image_numbering_next_tag\'] = 1',
+            timeit.timeit(lambda: cfg.__setitem__('image_numbering_next_tag', 1), number=n), n,
+            'us')
+    n = 10000
+    _report('reset_options()', timeit.timeit(cfg.reset_options, number=n), n, 'us')
+    _report('500 sections', timeit.timeit(lambda: BDoc().parse_string(txt), number=3), 3)
+
+
+def bench_blocks():
+    """deeply nested function blocks with labels"""
+    block = '{!div|level||\\label{l-%d}\n'
+    doc = []
+    for i in range(200):
+        doc += [block % (i * 10 + d) for d in range(10)] + ['text \\tag{b|bold}'] + ['!}'] * 10
+    txt = '\n'.join(doc) + '\n'
+    cfg = BParse(False).config
+    cfg.reset_options()
+    for i in range(20):
+        cfg['v:label%d' % i] = 'label'
+
+    def push_pop():
+        cfg.push_vars()
+        cfg.pop_vars()
+
+    n = 100000
+    _report('push/pop block', timeit.timeit(push_pop, number=n), n, 'us')
+    _report('2000 nested blocks', timeit.timeit(lambda: BDoc().parse_string(txt), number=3), 3)
+
+
+def bench_function():
+    """call the built-in function blocks, e.g., \\tag for each table cell"""
+    n = 100000
+    _report('BFunction().tag(data, \'td\')',
+            timeit.timeit(lambda: BFunction().tag('data', 'td'), number=n), n, 'us')
+    _report('BFunction.call(\'tag\', data, \'td\')',
+            timeit.timeit(lambda: BFunction.call('tag', 'data', 'td'), number=n), n, 'us')
+    txt = _synthetic(20000)
+    _report('20000 lines', timeit.timeit(lambda: BDoc().parse_string(txt), number=3), 3)
+
+
+def bench_warnings():
+    """noisy doc with 5000 undefined function blocks, and the 2nd scan"""
+    lines = ['text \\undefined{%d} \\tag{b|x}' % i for i in range(5000)]
+    txt = '\\ref{sec-end}\n' + '\n'.join(lines) + '\n= end \\label{sec-end}\n'
+    output = io.StringIO()
+
+    def run():
+        with contextlib.redirect_stdout(output):
+            BDoc().parse_string(txt)
+
+    n = 3
+    _report('noisy doc', timeit.timeit(run, number=n), n)
+    print('%-40s %10d' % ('lines of warnings', output.getvalue().count('\n') // n))
+    parser = BParse(False)
+    n = 100000
+    _report('scan info', timeit.timeit(lambda: parser._scan_info(lineno=1), number=n), n, 'us')
+
+
+def bench_page():
+    """peak RSS to generate a 40MB page (in a new process)"""
+    root = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(root, 'page.bsmdoc')
+        row = '<tr><td>cell</td><td>100%% value %d</td></tr>\n'
+        with open(filename, 'w') as fp:
+            # the raw blocks of 1000 rows, the lexer is slow for a huge block
+            fp.write('= reference\n{%<table>%}\n')
+            for i in range(40 * 1024 * 1024 // len(row % 0) // 1000):
+                fp.write('{%' + ''.join(row % (i * 1000 + j) for j in range(1000)) + '%}\n')
+            fp.write('{%</table>%}\n')
+        code = ('import resource, time, bsmdoc\n'
+                'start = time.time()\n'
+                'bsmdoc.BDoc().gen(%r)\n'
+                'print(time.time() - start, '
+                'resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n' % filename)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                                stdout=subprocess.PIPE).stdout.split()
+        size = os.path.getsize(os.path.join(root, 'page.html'))
+        _report('generate %.0fMB page' % (size / 1e6), float(output[-2]), unit='s')
+        print('%-40s %10.0f MB' % ('peak RSS', int(output[-1]) / 1024))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_output():
+    """write 100 pages of 100KB, unchanged vs changed"""
+    root = tempfile.mkdtemp()
+    try:
+        pages = [['<p>page %d</p>\n' % i, 'x' * 100 * 1024, '\n'] for i in range(100)]
+        files = [os.path.join(root, '%d.html' % i) for i in range(100)]
+
+        def run(pages):
+            return sum(_bsmdoc._bsmdoc_writefile(f, p) for f, p in zip(files, pages))
+
+        run(pages)
+        _report('unchanged (%d written)' % run(pages), timeit.timeit(lambda: run(pages),
+                                                                    number=5), 5)
+        changed = [p[:-1] + ['\n\n'] for p in pages]
+        _report('changed (%d written)' % run(changed),
+                timeit.timeit(lambda: (run(pages), run(changed)), number=5), 10)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_rewrap():
+    """gen() vs rewrap() after the template is changed (5000 lines)"""
+    root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(root, 'theme.cfg'), 'w') as fp:
+            fp.write('[footer]\ncontent = footer\n')
+        with open(os.path.join(root, 'main.bsmdoc'), 'w') as fp:
+            fp.write('\\config{bsmdoc_conf|theme.cfg}\n' + _synthetic(5000))
+        manifest = _bsmdoc.BManifest('main.bsmdoc', root)
+        doc = BDoc()
+        doc.gen('main.bsmdoc', path=root)
+        manifest.save(doc)
+        state = manifest.load_page()
+        _report('gen()', timeit.timeit(lambda: BDoc().gen('main.bsmdoc', path=root),
+                                       number=3), 3)
+        _report('load the saved state', timeit.timeit(manifest.load_page, number=3), 3)
+        _report('rewrap()',
+                timeit.timeit(lambda: BDoc().rewrap(state, 'main.bsmdoc', path=root),
+                              number=3), 3)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_gzip():
+    """generate and compress 20 docs (1000 lines), serial vs worker threads"""
+    root = tempfile.mkdtemp()
+    try:
+        names = ['%d.bsmdoc' % i for i in range(20)]
+        for name in names:
+            with open(os.path.join(root, name), 'w') as fp:
+                fp.write(_synthetic(1000))
+        doc = BDoc()
+
+        def serial():
+            for name in names:
+                doc.gen(name, path=root)
+                filename = doc.output_filename
+                with open(filename, 'rb') as fp, open(filename + '.gz', 'wb') as fp2:
+                    fp2.write(_bsmdoc.gzip.compress(fp.read(), 9))
+
+        def overlap():
+            compress = _bsmdoc.BGzip(9)
+            for name in names:
+                doc.gen(name, path=root)
+                filename = doc.output_filename
+                # force to compress again
+                if os.path.isfile(filename + '.gz'):
+                    os.remove(filename + '.gz')
+                compress.submit(filename)
+            compress.close()
+
+        _report('gen() only', timeit.timeit(lambda: [doc.gen(n, path=root) for n in names],
+                                            number=1), unit='s')
+        _report('gen() + gzip', timeit.timeit(serial, number=1), unit='s')
+        _report('gen() + BGzip', timeit.timeit(overlap, number=1), unit='s')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_minify():
+    """minify the page of the synthetic doc (20000 lines, table-heavy)"""
+    doc = BDoc()
+    doc.parse_string(_synthetic(20000))
+    doc.html_body = doc.parser.html
+    doc.cfg = doc.parser.config
+    body = doc.html_body.strip()
+    page = doc._page('', body)
+    size = sum(len(h) for h in page)
+    minify = _bsmdoc.BMinify()
+    seconds = timeit.timeit(lambda: minify.run(page, body), number=1)
+    _report('minify %.1fMB page' % (size / 1e6), seconds)
+    print('%-40s %10d (%.1f%%)' % ('bytes saved', minify.saved, minify.saved * 100 / size))
+
+
+def bench_lexer():
+    """lexer throughput on docs/index_content.bsmdoc"""
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docs',
+                            'index_content.bsmdoc')
+    with open(filename, encoding='utf-8') as fp:
+        txt = fp.read()
+    lines = txt.count('\n') + 1
+    parser = BParse(False)
+    lexer = parser.lexer
+
+    def tokens():
+        parser.config.reset_options()
+        lexer.begin('INITIAL')
+        lexer.lexstatestack = []
+        lexer.input(txt)
+        # the example files are generated when the doc is built, ignore the
+        # include errors
+        with contextlib.redirect_stdout(io.StringIO()):
+            return sum(1 for _ in lexer)
+
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(filename))
+    try:
+        count = tokens()
+        n = 20
+        seconds = timeit.timeit(tokens, number=n) / n
+    finally:
+        os.chdir(cwd)
+    _report('lex %d lines, %d tokens' % (lines, count), seconds)
+    print('%-40s %10.0f' % ('tokens/sec', count / seconds))
+    print('%-40s %10.0f' % ('lines/sec', lines / seconds))
+
+
+def bench_escape():
+    """lexer on the text with links, escaped characters and html tags"""
+    line = ('[http://a.com/?a=1&b=2|link <b>] \\{a\\} \\$1 \\<\\> a <= b, '
+            '[#anchor] c > d \\[e\\]\n')
+    txt = line * 5000
+    parser = BParse(False)
+    lexer = parser.lexer
+
+    def tokens():
+        lexer.begin('INITIAL')
+        lexer.lexstatestack = []
+        lexer.input(txt)
+        return sum(1 for _ in lexer)
+
+    count = tokens()
+    n = 5
+    seconds = timeit.timeit(tokens, number=n) / n
+    _report('lex 5000 lines, %d tokens' % count, seconds)
+    print('%-40s %10.0f' % ('tokens/sec', count / seconds))
+    n = 100000
+    _report('escape', timeit.timeit(lambda: _bsmdoc.bsmdoc_escape('a <b> c'), number=n), n,
+            'us')
+    _report('unescape',
+            timeit.timeit(lambda: _bsmdoc.bsmdoc_unescape('a &lt;b&gt; c'), number=n), n, 'us')
+
+
+def bench_readfile():
+    """_bsmdoc_readfile on a 1MB utf-8 doc, and a 1MB gbk doc"""
+    root = tempfile.mkdtemp()
+    try:
+        text = ('word 中文 café\n' * 80000)[:1 << 20]
+        for encoding in ['utf-8', 'gbk']:
+            filename = os.path.join(root, encoding + '.bsmdoc')
+            with open(filename, 'wb') as fp:
+                fp.write(text.encode(encoding, 'ignore'))
+
+            def cold():
+                _bsmdoc._readfile_cache.clear()
+                _bsmdoc._bsmdoc_readfile(filename, silent=True)
+
+            n = 10
+            _report('%s, read and decode' % encoding, timeit.timeit(cold, number=n), n)
+            n = 1000
+            _report('%s, memoized' % encoding,
+                    timeit.timeit(lambda: _bsmdoc._bsmdoc_readfile(filename, silent=True),
+                                  number=n), n)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_include():
+    """50 docs including a shared 500-line preamble, w/ and w/o pre-lexed tokens"""
+    root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(root, 'preamble.bsmdoc'), 'w') as fp:
+            fp.write(_synthetic(500))
+        with open(os.path.join(root, 'page.bsmdoc'), 'w') as fp:
+            fp.write('#include preamble.bsmdoc\n= page\ntext\n')
+        for tokens in [False, True]:
+            _bsmdoc._include_tokens.clear()
+
+            def run():
+                for _ in range(50):
+                    doc = BDoc()
+                    doc.parser.include_tokens = tokens
+                    doc.parse('page.bsmdoc', path=root)
+
+            _report('pre-lexed tokens %s' % tokens, timeit.timeit(run, number=1), unit='s')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_jobs():
+    """bsmdoc html --jobs on a 200-file corpus"""
+    root = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(200):
+            folder = os.path.join(root, 'part%d' % (i % 10))
+            os.makedirs(folder, exist_ok=True)
+            filename = os.path.join(folder, 'page%d.bsmdoc' % i)
+            with open(filename, 'w') as fp:
+                fp.write(_synthetic(1000))
+            files.append(filename)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        jobs = sorted({1, 2, 4, os.cpu_count() or 1})
+        serial = None
+        for j in jobs:
+            cmd = [sys.executable, '-m', 'bsmdoc', 'html', '--jobs', str(j)] + files
+            start = time.time()
+            subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+            seconds = time.time() - start
+            serial = serial or seconds
+            _report('--jobs %d (%.2fx, %d cpu)' % (j, serial / seconds, os.cpu_count()),
+                    seconds, unit='s')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_watch():
+    """BWatch re-generation latency for a one-line edit to a 1000-line doc"""
+    root = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(root, 'page.bsmdoc')
+        lines = _synthetic(1000).split('\n')
+        with open(filename, 'w') as fp:
+            fp.write('\n'.join(lines))
+        watch = BWatch([filename])
+        with contextlib.redirect_stdout(io.StringIO()):
+            watch.build(filename)
+            n = 10
+            seconds = 0
+            for i in range(n):
+                lines[2] = 'edit %d' % i
+                with open(filename, 'w') as fp:
+                    fp.write('\n'.join(lines))
+                start = time.time()
+                watch.step()
+                seconds += time.time() - start
+        _report('one-line edit', seconds, n)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_highlight():
+    """\\highlight with the cold/disk/memory cache"""
+    code = '{!highlight|python||{%%\ndef fun%d(a, b):\n    return a + b * %d\n%%}!}\n'
+    txt = ''.join(code % (i, i) for i in range(500))
+    cache = tempfile.mkdtemp()
+    os.environ['BSMDOC_CACHE_DIR'] = cache
+    try:
+        def run():
+            BDoc().parse_string(txt)
+
+        highlight_cache.clear()
+        _report('500 snippets, no cache', timeit.timeit(run, number=1))
+        highlight_cache.clear()
+        _report('500 snippets, disk cache', timeit.timeit(run, number=1))
+        _report('500 snippets, memory cache', timeit.timeit(run, number=1))
+        print('%-40s %10d %10d' % ('hits/misses', highlight_cache.hits, highlight_cache.misses))
+    finally:
+        del os.environ['BSMDOC_CACHE_DIR']
+        shutil.rmtree(cache, ignore_errors=True)
+
+
+def main(names):
+    benches = {k[6:]: v for k, v in globals().items() if k.startswith('bench_')}
+    for name in names or sorted(benches):
+        print('%s: %s' % (name, benches[name].__doc__))
+        start = time.time()
+        benches[name]()
+        _report('total', time.time() - start, unit='s')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,13 +1,16 @@
+import io
 import os
 import sys
+import contextlib
 import traceback
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from distutils.dir_util import copy_tree
 from distutils.file_util import copy_file
 from distutils import log
 import click
 from click_default_group import DefaultGroup
-from .bsmdoc import BDoc, _bsmdoc_error, __version__
+from .bsmdoc import BDoc, BManifest, BWatch, BServer, BGzip, _bsmdoc_error, __version__
 
 logging.basicConfig(level=logging.INFO)
 log.set_verbosity(log.INFO)
@@ -24,52 +27,208 @@ def cli():
 @click.option('--encoding', '-e', help="Set the input file encoding, e.g. 'utf-8'.")
 @click.option('--print-html', '-p', is_flag=True,
               help="Print the output html without saving to file.")
+@click.option('--single-pass', '-s', is_flag=True,
+              help="Resolve the forward references without a second scan.")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(0),
+              help="Number of processes to generate the files in parallel, "
+                   "0 for the number of CPUs.")
+@click.option('--force', '-f', is_flag=True,
+              help="Generate the html files even if their inputs are not changed.")
+@click.option('--explain', is_flag=True, help="Show why each file is (not) generated.")
+@click.option('--minify', is_flag=True,
+              help="Remove the whitespace between the block-level tags in the html file.")
+@click.option('--gzip', is_flag=True,
+              help="Also write the compressed html file (.html.gz), e.g., for nginx gzip_static.")
+@click.option('--gzip-level', default=9, type=click.IntRange(1, 9),
+              help="Compression level of the .gz file.")
 @click.option('--verbose', '-v', is_flag=True, help="Show more logging.")
 @click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False, allow_dash=True))
-def gen_html(files, lex_only, encoding, yacc_only, print_html, verbose):
-    for filename in files:
-        cur_path = os.getcwd()
-        try:
-            path, filename = os.path.split(filename)
-            if path:
-                os.chdir(path)
-            bsmdoc = BDoc(lex_only, verbose)
-            if yacc_only:
-                click.echo(bsmdoc.parse(filename, encoding))
+def gen_html(files, lex_only, encoding, yacc_only, print_html, single_pass, jobs, force,
+             explain, minify, gzip, gzip_level, verbose):
+    options = (lex_only, encoding, yacc_only, print_html, single_pass, force, explain, minify,
+               verbose)
+    jobs = min(jobs or os.cpu_count() or 1, len(files))
+    compress = None
+    if gzip and not (lex_only or yacc_only or print_html):
+        # compress the html file while generating the next one
+        compress = BGzip(gzip_level)
+    failed = changed = 0
+    if jobs <= 1:
+        for filename in files:
+            ok, updated = _gen_file(filename, *options)
+            failed += not ok
+            changed += updated
+            _compress_html(compress, filename, ok)
+    else:
+        with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                 initargs=(verbose,)) as pool:
+            results = [pool.submit(_gen_file_buffered, f, *options) for f in files]
+            # show the output in the order of the files
+            for filename, result in zip(files, results):
+                ok, updated, output = result.result()
+                if output:
+                    click.echo('==> %s' % click.format_filename(filename))
+                    click.echo(output, nl=False)
+                failed += not ok
+                changed += updated
+                _compress_html(compress, filename, ok)
+    if compress:
+        failed += compress.close()
+    if files and not (lex_only or yacc_only or print_html):
+        click.echo('%d of %d output(s) changed' % (changed, len(files)))
+    if compress:
+        click.echo('%d file(s) compressed' % compress.compressed)
+    if failed:
+        _bsmdoc_error('failed to generate %d file(s)' % failed)
+        sys.exit(1)
+
+
+def _gen_file(filename, lex_only, encoding, yacc_only, print_html, single_pass, force,
+              explain, minify, verbose):
+    """return (ok, whether the output file is changed)"""
+    # the files referred by the doc are relative to its folder, so no need to
+    # change the working directory
+    path, filename = os.path.split(filename)
+    manifest = None
+    if not (lex_only or yacc_only or print_html or filename == '-'):
+        # skip the file if its inputs are not changed since last time
+        options = {'encoding': encoding}
+        if minify:
+            options['minify'] = True
+        manifest = BManifest(filename, path, options)
+        reason = 'forced' if force else manifest.outdated()
+        if explain:
+            click.echo('%s: %s' % (click.format_filename(os.path.join(path, filename)),
+                                   reason or 'up to date, skip'))
+        if not reason:
+            return True, False
+    bsmdoc = BDoc(lex_only, verbose, single_pass)
+    bsmdoc.minify = minify
+    # show the warnings after the file is generated
+    bsmdoc.parser.log.deferred = True
+    try:
+        if yacc_only:
+            click.echo(bsmdoc.parse(filename, encoding, path))
+            click.echo('\n')
+        else:
+            text = None
+            if manifest and manifest.rewrap:
+                # only the configuration files are changed, try to assemble
+                # the page again without parsing the doc
+                text = bsmdoc.rewrap(manifest.load_page(), filename, encoding, True, path)
+                if explain and text:
+                    click.echo('%s: template only' % click.format_filename(
+                        os.path.join(path, filename)))
+            if text is None:
+                text = bsmdoc.gen(filename, encoding, not print_html, path)
+            if minify and not print_html:
+                click.echo('%s: %d bytes saved by minify' %
+                           (click.format_filename(os.path.join(path, filename)),
+                            bsmdoc.minify_saved))
+            if print_html:
+                click.echo(text)
                 click.echo('\n')
-            else:
-                text = bsmdoc.gen(filename, encoding, not print_html)
-                if print_html:
-                    click.echo(text)
-                    click.echo('\n')
-        except:
-            traceback.print_exc(file=sys.stdout)
-        os.chdir(cur_path)
+            if manifest:
+                manifest.save(bsmdoc)
+    except:
+        traceback.print_exc(file=sys.stdout)
+        return False, False
+    finally:
+        bsmdoc.parser.log.flush()
+    return True, bsmdoc.output_changed
+
+
+def _compress_html(compress, filename, ok):
+    # the .gz file is only updated if the html file is changed
+    if compress and ok and filename != '-':
+        compress.submit(os.path.splitext(filename)[0] + '.html')
+
+
+def _init_worker(verbose):
+    # build the parser tables once in each worker process, so the BDoc for
+    # each file is cheap to create
+    BDoc(False, verbose)
+
+
+def _gen_file_buffered(filename, *args):
+    # buffer the output, so the log from the files generated in parallel will
+    # not interleave
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        ok, changed = _gen_file(filename, *args)
+    return ok, changed, output.getvalue()
+
+
+@cli.command('watch', help='Re-generate the html files when their inputs are changed.',
+             short_help='Re-generate the html files when their inputs are changed.')
+@click.option('--encoding', '-e', help="Set the input file encoding, e.g. 'utf-8'.")
+@click.option('--single-pass', '-s', is_flag=True,
+              help="Resolve the forward references without a second scan.")
+@click.option('--interval', default=0.5, type=click.FloatRange(0.01),
+              help="Interval (in seconds) to check the files.")
+@click.option('--debounce', default=0.2, type=click.FloatRange(0),
+              help="Wait (in seconds) until the files stop changing.")
+@click.option('--verbose', '-v', is_flag=True, help="Show more logging.")
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def watch(files, encoding, single_pass, interval, debounce, verbose):
+    try:
+        BWatch(files, encoding, single_pass, verbose).run(interval, debounce)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command('serve', help='Serve the folder, and generate the html files on request.',
+             short_help='Serve the folder for preview.')
+@click.option('--host', default='127.0.0.1', help="The address to listen on.")
+@click.option('--port', '-p', default=8000, type=click.IntRange(0, 65535),
+              help="The port to listen on.")
+@click.option('--encoding', '-e', help="Set the input file encoding, e.g. 'utf-8'.")
+@click.option('--single-pass', '-s', is_flag=True,
+              help="Resolve the forward references without a second scan.")
+@click.option('--interval', default=0.5, type=click.FloatRange(0.01),
+              help="Interval (in seconds) to check the files to reload the pages.")
+@click.option('--verbose', '-v', is_flag=True, help="Show more logging.")
+@click.argument('folder', default='.', type=click.Path(exists=True, file_okay=False))
+def serve(folder, host, port, encoding, single_pass, interval, verbose):
+    try:
+        BServer(folder, encoding, single_pass, verbose).run(host, port, interval)
+    except KeyboardInterrupt:
+        pass
 
 
 @cli.command('init', help='Init a project from template by copying css/js files.',
              short_help='Init a project from template by copying css/js files.')
 @click.option('--no-index', is_flag=True, help="Do not include index.bsmdoc.")
 @click.option('--force', is_flag=True, help="Overwrite if file exits.")
+@click.option('--gzip', is_flag=True, help="Also write the compressed css/js files (.gz).")
+@click.option('--gzip-level', default=9, type=click.IntRange(1, 9),
+              help="Compression level of the .gz files.")
 @click.option('--verbose', '-v', is_flag=True, help="Show more logging.")
 @click.pass_context
-def new_prj(ctx, no_index, force, verbose):
-    update_prj('.', force, verbose)
+def new_prj(ctx, no_index, force, gzip, gzip_level, verbose):
+    update_prj('.', force, verbose, gzip_level if gzip else None)
     if not no_index:
         ctx.invoke(new_doc, files=['./index'], force=force, verbose=verbose)
 
 
-def update_prj(path, force, verbose):
+def update_prj(path, force, verbose, gzip_level=None):
     if not os.path.isdir(path):
         _bsmdoc_error("folder %s doesn't exist, choose another name!" % (path))
         return
 
     template = os.path.dirname(os.path.abspath(__file__))
     template = os.path.join(template, 'template')
-    copy_tree(os.path.join(template, 'css'), os.path.join(path, 'css'),
-              update=not force, verbose=verbose)
-    copy_tree(os.path.join(template, 'js'), os.path.join(path, 'js'),
-              update=not force, verbose=verbose)
+    files = copy_tree(os.path.join(template, 'css'), os.path.join(path, 'css'),
+                      update=not force, verbose=verbose)
+    files += copy_tree(os.path.join(template, 'js'), os.path.join(path, 'js'),
+                       update=not force, verbose=verbose)
+    if gzip_level:
+        # the copied files keep the mtime, so the .gz files are only updated
+        # if the files are changed
+        compress = BGzip(gzip_level)
+        for f in files:
+            compress.submit(f)
+        compress.close()
 
 
 
@@ -98,11 +257,15 @@ def new_doc(files, force, verbose):
 @cli.command('update', help='Update the CSS/JS files',
              short_help='Update the CSS/JS files.')
 @click.option('--force', is_flag=True, help="Overwrite if file exits.")
+@click.option('--gzip', is_flag=True, help="Also write the compressed css/js files (.gz).")
+@click.option('--gzip-level', default=9, type=click.IntRange(1, 9),
+              help="Compression level of the .gz files.")
 @click.option('--verbose', '-v', is_flag=True, help="Show more logging.")
 @click.argument('folders', nargs=-1, type=click.Path(exists=True, file_okay=False))
-def update_doc(folders, force, verbose):
+def update_doc(folders, force, gzip, gzip_level, verbose):
     for folder in folders:
-        update_prj(folder, force=force, verbose=verbose)
+        update_prj(folder, force=force, verbose=verbose,
+                   gzip_level=gzip_level if gzip else None)
 
 if __name__ == '__main__':
     cli()
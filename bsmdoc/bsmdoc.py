@@ -2,7 +2,25 @@ import sys
 import re
 import os
 import time
+import copy
+import functools
+import codecs
+import base64
+import gzip
+import locale
+import contextlib
+import hashlib
+import importlib
+import json
+import pickle
+import types
+import threading
 import traceback
+import collections
+import multiprocessing
+import http.server
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from ast import literal_eval
 import six
 from six.moves import configparser
@@ -10,6 +28,7 @@ from ply import lex, yacc
 import click
 import cchardet as chardet
 
+import pygments
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import HtmlFormatter
@@ -17,12 +36,181 @@ from pygments.formatters import HtmlFormatter
 __version__ = '0.0.9'
 
 
+def _bsmdoc_cache_root():
+    root = os.environ.get('BSMDOC_CACHE_DIR')
+    if not root:
+        root = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+        if not root:
+            root = os.path.join(os.path.expanduser('~'), '.cache')
+        root = os.path.join(root, 'bsmdoc')
+    return root
+
+
+def _bsmdoc_cache_dir(*paths):
+    """
+    return the folder to store the bsmdoc cache (e.g., parser tables), or
+    None if it is not available.
+    The root folder can be set with environment variable BSMDOC_CACHE_DIR.
+    """
+    path = os.path.join(_bsmdoc_cache_root(), *paths)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+
+class BCache(object):
+    """
+    LRU cache in memory, and backed by the files in the user cache folder
+    (e.g., ~/.cache/bsmdoc/highlight), so the cached values can also be used
+    by the later runs. The value is a string.
+    """
+    def __init__(self, name, size=1024, disk_size=16384):
+        self.name = name
+        # the max number of values in memory and on disk
+        self.size = size
+        self.disk_size = disk_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # the cache folder, and the root folder it is created for
+        self._folder = None
+        self._root = None
+        self._disk_count = 0
+
+    @staticmethod
+    def key(*args):
+        """return the hash of the args, which shall have stable repr"""
+        return hashlib.sha1(repr(args).encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def _path(self, key):
+        # the root folder is checked on each access, so it follows
+        # BSMDOC_CACHE_DIR (e.g., set by the tests)
+        root = _bsmdoc_cache_root()
+        if root != self._root:
+            # create the folder on first use
+            self._root = root
+            self._folder = _bsmdoc_cache_dir(self.name)
+            self._disk_count = len(os.listdir(self._folder)) if self._folder else 0
+        if not self._folder:
+            return None
+        return os.path.join(self._folder, key)
+
+    def get(self, key):
+        """return the cached value, or None if not found"""
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            path = self._path(key)
+        value = None
+        if path:
+            try:
+                with open(path, 'r', encoding='utf-8', newline='') as fp:
+                    value = fp.read()
+                # update the mtime, so it is recently used
+                os.utime(path)
+            except (IOError, OSError, ValueError):
+                value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+            path = self._path(key)
+        if not path:
+            return
+        try:
+            # write to a temporary file first, so the other processes will
+            # not read a partial file
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with open(tmp, 'w', encoding='utf-8', newline='') as fp:
+                fp.write(value)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            self._disk_count += 1
+            if self._disk_count <= self.disk_size:
+                return
+        self._prune()
+
+    def _set(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def _prune(self):
+        # remove the least recently used files on disk
+        folder = self._folder
+        try:
+            files = [os.path.join(folder, f) for f in os.listdir(folder)]
+            files.sort(key=lambda f: os.stat(f).st_mtime)
+        except OSError:
+            return
+        # remove more files than necessary, so it does not need to prune
+        # again soon
+        remove = files[:max(len(files) - self.disk_size * 9 // 10, 0)]
+        for f in remove:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_count = len(files) - len(remove)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+
 class BConfig(object):
     """
     class to hold all the configurations
     """
+    # the value needs interpolation (e.g., '%(title)s'), which is done when
+    # it is read, as the referred value may be changed later
+    _interp = object()
+    _interp_re = re.compile(r'%(?:%|\(([^)]+)\)s)?')
+    # same as configparser
+    _interp_depth = 10
+    # the parsed configurations in ini format, {hash of the text: sections}
+    _ini_cache = collections.OrderedDict()
+    _ini_cache_size = 64
+    _ini_lock = threading.Lock()
+    # (bsmdoc_conf, the default sections)
+    _defaults = None
+    # the configurations only used to assemble the html page (e.g., the
+    # header/footer, css/js), but not to parse the doc; so the page can be
+    # assembled again with the new template without parsing the doc (see
+    # BDoc.rewrap)
+    _template_sections = frozenset(['html', 'header', 'body', 'footer'])
+    _template_keys = frozenset(['css', 'js', 'title', 'doctitle', 'subtitle', 'show_source',
+                                'show_table_of_contents'])
+
     def __init__(self):
-        self.config = configparser.ConfigParser(delimiters=('=', ))
+        # {section: {key: (raw string, parsed value)}}; same as ConfigParser,
+        # the key is case-insensitive, the value is stored as string (i.e.,
+        # str(value)), and converted to python literal if possible. And the
+        # section falls back to DEFAULT if the key is not found.
+        self._sections = {'DEFAULT': {}}
+        # the block variables ('v' section) of the enclosing blocks; each
+        # block starts with an empty 'v' section, and the enclosing one is
+        # restored when the block ends, so it is O(1) to enter/leave a block
+        self._vars_stack = []
+        # the anchors defined by the doc (e.g., \label{}), {anchor: text}
+        self.anchors = {}
         # cite & reference
         self.refs = {}
         self.cited = []
@@ -34,80 +222,116 @@ class BConfig(object):
         self.footnotes = []
         # alias
         self.alias = {}
+        # the template configurations set by the doc in order, e.g.,
+        # ['set', sec, key, raw], or ['file', filename, digest] for the
+        # configuration file (digest of its non-template configurations)
+        self.templates = []
         self._scan = 0
         self._need_scan = True # at least scan once
+        # in single pass mode, the forward references are not resolved with a
+        # 2nd scan; instead, the function blocks are deferred to the end of
+        # the scan, and a placeholder is generated in the output
+        self.single_pass = False
+        self._deferred = []
+        self._deferred_results = {}
+        self._resolving = False
 
         self.scan_info = {}
 
     def __getitem__(self, item):
         if isinstance(item, six.string_types):
-            items = item.split(':')
-            if len(items) == 1:
-                return self.get_cfg('DEFAULT', items[0])
-            elif len(items) >= 2:
-                return self.get_cfg(items[0], ':'.join(items[1:]))
+            sec, _, key = item.partition(':')
+            if not _:
+                return self.get_cfg('DEFAULT', sec)
+            if sec == 'ANCHOR':
+                return self.anchors.get(key.lower(), '')
+            return self.get_cfg(sec, key)
         return ""
 
     def __setitem__(self, item, value):
         if isinstance(item, six.string_types):
-            items = item.split(':')
-            if len(items) == 1:
-                return self.set_cfg('DEFAULT', items[0], value)
-            elif len(items) >= 2:
-                return self.set_cfg(items[0], ':'.join(items[1:]), value)
+            sec, _, key = item.partition(':')
+            if not _:
+                return self.set_cfg('DEFAULT', sec, value)
+            if sec == 'ANCHOR':
+                self.anchors[key.lower()] = value
+                return None
+            return self.set_cfg(sec, key, value)
         return ""
 
-    def get_vars(self):
-        if self.config.has_section('v'):
-            return dict(self.config._sections['v'])
-        return {}
+    def push_vars(self):
+        """
+        enter a block, the block variables (e.g., label, caption) defined in
+        the block will not change the enclosing block
+        """
+        self._vars_stack.append(self._sections.get('v', {}))
+        self._sections['v'] = {}
 
-    def set_vars(self, sec):
-        self.config.remove_section('v')
-        self.config.add_section('v')
-        for k, v in six.iteritems(sec):
-            self.config.set('v', k, v)
+    def pop_vars(self):
+        """leave the block, and restore the variables of the enclosing block"""
+        if self._vars_stack:
+            self._sections['v'] = self._vars_stack.pop()
 
-    def reset_options(self):
-        for k, _ in self.config.items('DEFAULT'):
-            self.config.remove_option('DEFAULT', k)
+    @classmethod
+    def _default_sections(cls):
+        """
+        return the default configurations (bsmdoc_conf and the default
+        options), which are only parsed once, and applied to each scan
+        """
+        defaults = cls._defaults
+        if defaults is None or defaults[0] is not bsmdoc_conf:
+            cfg = cls()
+            cfg.load(bsmdoc_conf)
+            cfg['title'] = ''
+            cfg['doctitle'] = '%(TITLE)s'
+            cfg['subtitle'] = ''
+            cfg['show_source'] = False
+            cfg['heading_numbering'] = False
+            cfg['heading_numbering_start'] = 1
+            cfg['heading_in_contents'] = True
+            cfg['show_table_of_contents'] = False
+
+            cfg['image_numbering'] = False
+            cfg['image_numbering_prefix'] = 'Fig.'
+            cfg['image_numbering_num_prefix'] = ''
+            cfg['image_numbering_next_tag'] = 0
+
+            cfg['video_numbering'] = 'image' # share numbering with image block
+            cfg['video_numbering_prefix'] = 'Video.'
+            cfg['video_numbering_num_prefix'] = ''
+            cfg['video_numbering_next_tag'] = 0
+
+            cfg['table_numbering'] = False
+            cfg['table_numbering_prefix'] = 'Table.'
+            cfg['table_numbering_num_prefix'] = ''
+            cfg['table_numbering_next_tag'] = 0
+
+            cfg['has_equation_ref'] = False
+            defaults = cls._defaults = (bsmdoc_conf, cfg._sections)
+        return defaults[1]
 
-        self.load(bsmdoc_conf)
+    def reset_options(self):
+        self._sections['DEFAULT'] = {}
+        self._vars_stack = []
+        self._overlay(self._default_sections())
         self.set_updated(time.gmtime(), True)
-        self['title'] = ''
-        self['doctitle'] = '%(TITLE)s'
-        self['subtitle'] = ''
-        self['show_source'] = False
-        self['heading_numbering'] = False
-        self['heading_numbering_start'] = 1
-        self['heading_in_contents'] = True
-        self['show_table_of_contents'] = False
-
-        self['image_numbering'] = False
-        self['image_numbering_prefix'] = 'Fig.'
-        self['image_numbering_num_prefix'] = ''
-        self['image_numbering_next_tag'] = 0
-
-        self['video_numbering'] = 'image' # share numbering with image block
-        self['video_numbering_prefix'] = 'Video.'
-        self['video_numbering_num_prefix'] = ''
-        self['video_numbering_next_tag'] = 0
-
-        self['table_numbering'] = False
-        self['table_numbering_prefix'] = 'Table.'
-        self['table_numbering_num_prefix'] = ''
-        self['table_numbering_next_tag'] = 0
-
-        self['has_equation_ref'] = False
 
         self.footnotes = []
         self.contents = []
         self.heading_tag = {}
         self.cited = []
         self.alias = {}
+        self.templates = []
+        self._deferred = []
+        self._deferred_results = {}
 
     def set_updated(self, t, forced=False):
         time_format = '%Y-%m-%d %H:%M:%S UTC'
+        # the time shall not be later than SOURCE_DATE_EPOCH, so the output is
+        # reproducible (https://reproducible-builds.org/specs/source-date-epoch/)
+        epoch = _bsmdoc_source_date()
+        if epoch is not None and t > epoch:
+            t = epoch
         if forced or not self['updated']:
             self['updated'] = time.strftime(time_format, t)
         else:
@@ -125,9 +349,14 @@ class BConfig(object):
     def need_scan(self) -> bool:
         return self._need_scan
 
-    def request_scan(self):
+    def request_scan(self, force=False):
         """request for a second scan, return false if it is the 2nd scan now"""
-        if self._scan == 1:
+        # in single pass mode, the 2nd scan is only requested when resolving
+        # the deferred function blocks (e.g., the citation to an undefined
+        # reference), so the output is same as the one with two scans.
+        # force is for the text can't be deferred (e.g., the included file
+        # generated by the doc in tree mode).
+        if self._scan == 1 and (force or not self.single_pass or self._resolving):
             self._need_scan = True
             return True
         return False
@@ -136,20 +365,264 @@ class BConfig(object):
         self._scan = 0
         self._need_scan = True
 
+    _deferred_re = re.compile('\ue000(\\d+)\ue001')
+
+    def can_defer(self) -> bool:
+        return self.single_pass and self._scan == 1 and not self._resolving
+
+    def defer(self, fun, *args, **kwargs) -> str:
+        """
+        defer fun(*args, **kwargs) to the end of the scan, and return the
+        placeholder of its output
+        """
+        self._deferred.append((fun, args, kwargs))
+        return '\ue000%d\ue001' % (len(self._deferred) - 1)
+
+    def resolve_deferred(self):
+        """call the deferred functions in order, and fix their placeholders"""
+        if not self._deferred:
+            return
+        self._resolving = True
+        try:
+            results = [str(fun(*args, **kwargs)) for fun, args, kwargs in self._deferred]
+        finally:
+            self._resolving = False
+
+        def expand(idx):
+            # the output may also contain the placeholders, e.g., the text of
+            # the anchor to a heading, which has a reference
+            if idx not in self._deferred_results:
+                self._deferred_results[idx] = ''
+                self._deferred_results[idx] = self._deferred_re.sub(
+                    lambda m: expand(int(m.group(1))), results[idx])
+            return self._deferred_results[idx]
+        for i in range(len(results)):
+            expand(i)
+
+        self.contents = [[c[0], self.fixup(c[1]), c[2]] for c in self.contents]
+        self.footnotes = [self.fixup(f) for f in self.footnotes]
+        for c in self.cited:
+            c[0] = self.fixup(c[0])
+
+    def fixup(self, txt):
+        """replace the placeholders in txt with the output of deferred functions"""
+        if not self._deferred_results or not isinstance(txt, str):
+            return txt
+        return self._deferred_re.sub(lambda m: self._deferred_results[int(m.group(1))], txt)
+
+    def _get_raw(self, sec, key):
+        section = self._sections.get(sec)
+        if section is None:
+            return None
+        item = section.get(key)
+        if item is None:
+            item = self._sections['DEFAULT'].get(key)
+        return item
+
+    def _interpolate(self, sec, key, raw, depth=1):
+        if depth > self._interp_depth:
+            raise configparser.InterpolationDepthError(key, sec, raw)
+
+        def _sub(m):
+            if m.group(0) == '%%':
+                return '%'
+            if m.group(1) is None:
+                raise configparser.InterpolationSyntaxError(
+                    key, sec, "'%%' must be followed by '%%' or '(', found: %r" % raw)
+            var = m.group(1).lower()
+            item = self._get_raw(sec, var)
+            if item is None:
+                raise configparser.InterpolationMissingOptionError(key, sec, raw, var)
+            if item[1] is self._interp:
+                return self._interpolate(sec, key, item[0], depth + 1)
+            return item[0]
+        return self._interp_re.sub(_sub, raw)
+
     def get_cfg(self, sec, key):
-        val = ''
-        if self.config.has_option(sec, key):
-            val = _to_literal(self.config.get(sec, key))
+        key = key.lower()
+        item = self._get_raw(sec, key)
+        if item is None:
+            return ''
+        raw, val = item
+        if val is self._interp:
+            return _to_literal(self._interpolate(sec, key, raw))
+        if isinstance(val, (list, dict, set)):
+            # the caller may change it
+            return copy.deepcopy(val)
         return val
 
+    @classmethod
+    def _parse(cls, raw):
+        # same as ConfigParser, '%' shall be followed by '%' or '(name)s'
+        if '%' in raw:
+            tmp = cls._interp_re.sub(lambda m: m.group(0) if m.group(0) == '%' else '', raw)
+            if '%' in tmp:
+                raise ValueError("invalid interpolation syntax in %r at position %d" %
+                                 (raw, tmp.find('%')))
+            return (raw, cls._interp)
+        return (raw, _to_literal(raw))
+
     def set_cfg(self, sec, key, val):
-        if sec != 'DEFAULT' and not self.config.has_section(sec):
-            # add section if necessary
-            self.config.add_section(sec)
-        self.config.set(sec, key, str(val))
+        if val is None or isinstance(val, (bool, int)):
+            item = (str(val), val)
+        else:
+            item = self._parse(str(val))
+        key = key.lower()
+        if sec in self._template_sections or (sec == 'DEFAULT' and key in self._template_keys):
+            # same as _is_template
+            self.templates.append(['set', sec, key, item[0]])
+        # add section if necessary
+        self._sections.setdefault(sec, {})[key] = item
+
+    def load(self, txt, filename=None):
+        """load the configurations in ini format (from filename if not None)"""
+        sections = self._parse_ini(txt)
+        self._overlay(sections)
+        if filename is not None:
+            self.templates.append(['file', filename, self._template_split(sections)[1]])
+            return
+        for sec, items in six.iteritems(sections):
+            for key, item in six.iteritems(items):
+                if self._is_template(sec, key):
+                    self.templates.append(['set', sec, key, item[0]])
+
+    @classmethod
+    def _is_template(cls, sec, key):
+        return sec in cls._template_sections or (sec == 'DEFAULT' and key in cls._template_keys)
+
+    @classmethod
+    def _template_split(cls, sections):
+        """
+        return the template configurations, and the digest of the others
+        """
+        templates, others = {}, []
+        for sec, items in six.iteritems(sections):
+            for key, item in six.iteritems(items):
+                if cls._is_template(sec, key):
+                    templates.setdefault(sec, {})[key] = item
+                else:
+                    others.append((sec, key, item[0]))
+        digest = hashlib.sha1(repr(sorted(others)).encode('utf-8', 'surrogatepass')).hexdigest()
+        return templates, digest
+
+    def state(self):
+        """
+        return the configurations and the metadata (e.g., anchors, citations,
+        footnotes) collected from the doc, which can be saved as json and
+        restored later (see restore)
+        """
+        sections = {sec: {key: item[0] for key, item in six.iteritems(items)}
+                    for sec, items in six.iteritems(self._sections) if sec != 'v'}
+        return {'sections': sections,
+                'templates': list(self.templates),
+                'anchors': dict(self.anchors),
+                'cited': list(self.cited),
+                'footnotes': list(self.footnotes),
+                'deferred': sorted(self._deferred_results.items())}
+
+    def restore(self, state):
+        """
+        restore the configurations from state(), with the template applied
+        again (e.g., the configuration file is read again); return False if
+        the non-template configurations in the configuration file are
+        changed, so the doc needs to be parsed again
+        """
+        self.reset_options()
+        for sec, items in six.iteritems(state['sections']):
+            section = self._sections.setdefault(sec, {})
+            for key, raw in six.iteritems(items):
+                if not self._is_template(sec, key):
+                    section[key] = self._parse(raw)
+        for t in state['templates']:
+            if t[0] == 'set':
+                self.set_cfg(t[1], t[2], t[3])
+                continue
+            try:
+                sections = self._parse_ini(_bsmdoc_readfile(t[1], silent=True))
+            except (IOError, OSError, ValueError, configparser.Error):
+                return False
+            templates, digest = self._template_split(sections)
+            if digest != t[2]:
+                return False
+            self._overlay(templates)
+            self.templates.append(['file', t[1], digest])
+        self.anchors = dict(state['anchors'])
+        self.cited = [list(c) for c in state['cited']]
+        self.footnotes = list(state['footnotes'])
+        self._deferred_results = {int(k): v for k, v in state['deferred']}
+        return True
+
+    def _overlay(self, sections):
+        # the items are immutable (the list/dict value is copied when read),
+        # so they can be shared by the configurations
+        for sec, items in six.iteritems(sections):
+            self._sections.setdefault(sec, {}).update(items)
+
+    @classmethod
+    def _parse_ini(cls, txt):
+        # the configurations are parsed once, and cached by the hash of the
+        # text, e.g., the configuration file applied to each scan of each doc
+        key = hashlib.sha1(txt.encode('utf-8', 'surrogatepass')).hexdigest()
+        with cls._ini_lock:
+            sections = cls._ini_cache.get(key)
+            if sections is not None:
+                cls._ini_cache.move_to_end(key)
+                return sections
+        config = configparser.ConfigParser(delimiters=('=', ), interpolation=None)
+        config.read_string(txt)
+        items = [('DEFAULT', config.defaults())]
+        items += [(sec, config._sections[sec]) for sec in config.sections()]
+        sections = {}
+        for sec, section in items:
+            sections[sec] = {key: cls._parse(raw) for key, raw in six.iteritems(section)}
+        with cls._ini_lock:
+            cls._ini_cache[key] = sections
+            while len(cls._ini_cache) > cls._ini_cache_size:
+                cls._ini_cache.popitem(last=False)
+        return sections
+
+
+class BLexer(lex.Lexer):
+    """
+    lexer which can replay the pre-lexed tokens (e.g., the included file)
+    before continuing with its input
+    """
+    _replay = None
+
+    def replay(self, tokens):
+        self._replay = iter(tokens)
+
+    def token(self):
+        if self._replay is not None:
+            for typ, value, lineno, lexpos, after in self._replay:
+                tok = lex.LexToken()
+                tok.type = typ
+                tok.value = value
+                tok.lineno = lineno
+                tok.lexpos = lexpos
+                tok.lexer = self
+                self.lineno = after
+                return tok
+            # same as eof, return to the up-level
+            self._replay = None
+            self.lexmodule.restore_input(self)
+        return lex.Lexer.token(self)
 
-    def load(self, txt):
-        self.config.read_string(txt)
+
+class _BLexError(Exception):
+    pass
+
+
+def _bsmdoc_lex_error(t):
+    raise _BLexError(t.value[0])
+
+
+# the pre-lexed tokens of the included files, so the file included by
+# multiple docs (or scans) is only lexed once;
+# (path, lexer state) -> (text, tokens)
+_include_tokens = collections.OrderedDict()
+_include_tokens_lock = threading.Lock()
+_include_tokens_size = 64
 
 
 class BParse(object):
@@ -191,27 +664,121 @@ class BParse(object):
 
     # Tokens
     t_ignore = '\t'
+    _space_re = re.compile(r' [^\S\r\n]+')
     t_rblock_ignore = ''
     t_equation_ignore = ''
 
-    def __init__(self, verbose):
-        lex.lex(module=self, reflags=re.M)
-        yacc.yacc(module=self, debug=verbose)
+    # the lexer and parser tables shared by all the instances of each class,
+    # so the tables are only generated once in a process
+    _tables = {}
+    _tables_lock = threading.Lock()
+
+    def __init__(self, verbose, single_pass=False, tree=False):
+        self.lexer, self.parser = self._build(verbose)
 
-        # add function block \__version__ = __version__
-        BFunction('__version__')(__version__)
+        # the function blocks defined by the doc (e.g., \newfun, or
+        # @BFunction in exec block), which override the global ones
+        self.interfaces = {}
+        # the namespace to run the code from exec/eval block
+        self.namespace = None
         self.html = ""
         self.config = BConfig()
+        self.config.single_pass = single_pass
+        # in tree mode, the parser generates the document tree (self.root)
+        # first, which is then rendered to html by BRender
+        self.tree = tree
+        self.root = None
         self.verbose = verbose
         self.filename = ""
+        # the folder of the doc, the files referred by the doc (e.g., include)
+        # are relative to it
+        self.path = ""
+        # the files read by the doc (e.g., include, config), and their hash
+        self.dependencies = {}
+        # replay the pre-lexed tokens of the included file if possible
+        self.include_tokens = True
+        # the warnings and errors of the doc
+        self.log = BLog()
+        # the async code (exec/eval block) running for the doc, which is only
+        # started once for all the scans
+        self.code_jobs = {}
         self._input_stack = []
+        # the files included by the doc, which don't exist when parsed
+        self._missing_includes = []
         self.contents = ''
+        # the ranges ([start, end]) of the raw blocks ({% %}) in the html,
+        # which are preserved by BMinify
+        self.raw_ranges = []
 
         # function block supports embedded block, remember the current block
         # level to print the error message correspondingly when error occurs.
         self.block_state = []
         self.heading_level = 0
 
+    def _build(self, verbose):
+        """create the lexer and parser bound to this instance"""
+        cls = type(self)
+        with BParse._tables_lock:
+            if cls not in BParse._tables:
+                BParse._tables[cls] = self._build_tables(verbose)
+            lexer, parser = BParse._tables[cls]
+
+        # rebind the lexer rules to the methods of this instance; not use
+        # lexer.clone(), which drops the rules when a state has more than one
+        # master regex, and does not rebind the eof functions
+        def rebind(fun):
+            if fun and fun[0]:
+                return (getattr(self, fun[0].__name__), fun[1])
+            return fun
+        lexer = copy.copy(lexer)
+        lexer.lexstatere = {state: [(cre, [rebind(f) for f in findex]) for cre, findex in ritem]
+                            for state, ritem in lexer.lexstatere.items()}
+        lexer.lexstateerrorf = {state: getattr(self, f.__name__)
+                                for state, f in lexer.lexstateerrorf.items()}
+        lexer.lexstateeoff = {state: getattr(self, f.__name__)
+                              for state, f in lexer.lexstateeoff.items()}
+        lexer.lexmodule = self
+        lexer.lexstatestack = []
+        lexer.begin('INITIAL')
+
+        # the parser tables are read only, only need to bind the productions
+        # to the methods of this instance
+        productions = []
+        for prod in parser.productions:
+            prod = copy.copy(prod)
+            if prod.func:
+                prod.callable = getattr(self, prod.func)
+            productions.append(prod)
+        parser = copy.copy(parser)
+        parser.productions = productions
+        parser.errorfunc = self.p_error
+        return lexer, parser
+
+    def _build_tables(self, verbose):
+        """
+        build the lexer and parser tables. The LALR tables are pickled to the
+        cache folder, and named with the hash of the grammar, so they are only
+        re-generated when the grammar (or bsmdoc/ply) changes.
+        """
+        lexer = lex.lex(module=self, reflags=re.M)
+        lexer.__class__ = BLexer
+
+        grammar = [__version__, lex.__version__, repr(self.tokens), repr(self.states)]
+        for name in sorted(dir(self)):
+            if name.startswith('p_'):
+                grammar.append('%s:%s' % (name, getattr(self, name).__doc__))
+        signature = hashlib.sha1('\n'.join(grammar).encode()).hexdigest()
+
+        kwargs = {'debug': False, 'write_tables': False}
+        cache = _bsmdoc_cache_dir()
+        if cache:
+            # parser.out is only generated when the tables are re-generated
+            kwargs.update({'debug': verbose,
+                           'outputdir': cache,
+                           'picklefile': os.path.join(cache, 'parsetab-%s.pickle' % signature)})
+        parser = yacc.yacc(module=self, **kwargs)
+        return lexer, parser
+
     def top_block(self):
         if self.block_state:
             return self.block_state[-1]
@@ -221,8 +788,7 @@ class BParse(object):
         if self.block_state:
             args = self.block_state.pop()
             self.heading_level = args['heading_level']
-            self.config.set_vars(args['config'])
-            args.pop('config', None)
+            self.config.pop_vars()
             args.pop('heading_level', None)
             return args
         self._error('no more blocks', lineno=lineno)
@@ -233,10 +799,9 @@ class BParse(object):
         if args['block'] == 'heading':
             self.heading_level = len(self.block_state)
         args['heading_level'] = self.heading_level
-        # save the default section in configuration, so that when leave the
-        # block, the configuration in the block will not change the upper level
-        args['config'] = self.config.get_vars()
-        self.config.set_vars({})
+        # the block variables (e.g., \label{}) in the block will not change the
+        # upper level
+        self.config.push_vars()
         self.block_state.append(args)
 
     def scan(self, txt):
@@ -248,36 +813,85 @@ class BParse(object):
         self.config.reset_options()
         self.config['filename'] = self.filename
         self.config['basename'] = os.path.basename(self.filename)
-        if os.path.isfile(self.filename):
-            mt = time.gmtime(os.path.getmtime(self.filename))
+        filename = _bsmdoc_path(self.filename)
+        if os.path.isfile(filename):
+            mt = time.gmtime(os.path.getmtime(filename))
         else:
             mt = time.gmtime()
         self.config.set_updated(mt, True)
-        lex.lexer.lineno = 1
-        yacc.parse(txt, tracking=True)
+        self.lexer.begin('INITIAL')
+        self.lexer.lexstatestack = []
+        self.lexer.lineno = 1
+        self.lexer._replay = None
+        self._input_stack = []
+        self.raw_ranges = []
+        self.root = None
+        self._missing_includes = []
+        self.parser.parse(txt, lexer=self.lexer, tracking=True)
+        if self.tree and self.root is not None:
+            self.block_state = []
+            self.heading_level = 0
+            self.html = BRender(self).render(self.root)
+        self._check_includes()
+
+    def _check_includes(self):
+        """
+        in tree mode, the function blocks are called after the text is
+        parsed, so the file included by the doc may be generated (or the
+        include block overridden) by the earlier blocks after it is
+        included. Scan the doc again if so; otherwise, report the missing file.
+        """
+        if not self._missing_includes:
+            return
+        overridden = BFunction.get('include') is not bsmdoc_include
+        for filename, kwargs in self._missing_includes:
+            if overridden or os.path.isfile(_bsmdoc_path(filename)):
+                if self.config.request_scan(True):
+                    return
+        for filename, kwargs in self._missing_includes:
+            BFunction.call('include', filename, **kwargs)
 
     def run(self, txt, filename="<input>", lex_only=False):
+        with BFunction.scope(self):
+            return self._run(txt, filename, lex_only)
+
+    def _run(self, txt, filename, lex_only):
         self.filename = filename
         if lex_only:
             # output the lexer token for debugging
-            lex.input(txt)
-            for tok in lex.lexer:
+            self.lexer.input(txt)
+            for tok in self.lexer:
                 click.echo(tok)
             return None
 
+        self.log.clear()
+        self.code_jobs = {}
         self.config.reset_scan()
         while self.config.need_scan():
             self.scan(txt)
+            self.config.resolve_deferred()
 
-        self.contents = BFunction().makecontent(self.config.contents)
+        self.html = self.config.fixup(self.html)
+        if _raw_begin in self.html:
+            self.html, self.raw_ranges = _bsmdoc_unmark_raw(self.html)
+        self.contents = BFunction.call('makecontent', self.config.contents)
         return self.html
 
+    def reset(self):
+        """
+        reset the states defined by the previous doc (e.g., the function
+        blocks), so the parser can be reused for another doc
+        """
+        self.interfaces = {}
+        self.namespace = None
+        self.dependencies = {}
+
     def pop_input(self):
         if self._input_stack:
             return self._input_stack.pop()
         return None
 
-    def push_input(self, t, txt):
+    def push_input(self, t, txt, filename=None):
         status = {
             'lexdata': t.lexer.lexdata,
             'lexpos': t.lexer.lexpos,
@@ -285,49 +899,121 @@ class BParse(object):
             'filename': self.filename
         }
         self._input_stack.append(status)
-        t.lexer.input(txt)
+        tokens = self.prelex(t.lexer, txt, filename) if filename else None
+        if tokens is not None:
+            t.lexer.replay(tokens)
+        else:
+            t.lexer.input(txt)
         t.lexer.lineno = 1
 
+    def prelex(self, lexer, txt, filename):
+        """
+        return the tokens of the included text, or None if it can't be lexed
+        in advance, e.g.,
+            - it includes other files, or has side effects (e.g., #makecontent);
+            - it has lexer error;
+            - it doesn't end in the same state (e.g., unmatched block);
+            - escape is overridden by the doc, which changes the tokens.
+        The tokens are cached, and re-lexed when the file is changed.
+        """
+        if not self.include_tokens:
+            return None
+        if '#include' in txt or '#makecontent' in txt:
+            return None
+        if BFunction.get('escape') is not bsmdoc_escape:
+            return None
+        key = (_bsmdoc_path(filename), lexer.lexstate, tuple(lexer.lexstatestack))
+        with _include_tokens_lock:
+            cached = _include_tokens.get(key)
+            if cached is not None and cached[0] is txt:
+                _include_tokens.move_to_end(key)
+                return cached[1]
+
+        # lex with a copy, so the current lexer is not changed
+        lex2 = copy.copy(lexer)
+        lex2._replay = None
+        lex2.lexstateeoff = {}
+        lex2.lexstateerrorf = {state: _bsmdoc_lex_error for state in lexer.lexstateerrorf}
+        lex2.lexstatestack = list(lexer.lexstatestack)
+        lex2.begin(lexer.lexstate)
+        lex2.input(txt)
+        lex2.lineno = 1
+        tokens = []
+        try:
+            for tok in iter(lex2.token, None):
+                tokens.append((tok.type, tok.value, tok.lineno, tok.lexpos, lex2.lineno))
+        except _BLexError:
+            return None
+        if lex2.lexstate != lexer.lexstate or lex2.lexstatestack != lexer.lexstatestack:
+            return None
+        with _include_tokens_lock:
+            _include_tokens[key] = (txt, tokens)
+            _include_tokens.move_to_end(key)
+            while len(_include_tokens) > _include_tokens_size:
+                _include_tokens.popitem(last=False)
+        return tokens
+
     def _touch(self, t):
         self.config['lineno'] = t.lexer.lineno
         return self.config
 
     def _info(self, msg, **kwargs):
-        info = self._scan_info(**kwargs)
-        _bsmdoc_info(msg, **info)
+        if self.verbose:
+            _bsmdoc_info(msg, **self._scan_info(**kwargs))
 
     def _warning(self, msg, **kwargs):
-        info = self._scan_info(**kwargs)
-        _bsmdoc_warning(msg, **info)
+        _bsmdoc_warning(msg, **self._scan_info(**kwargs))
 
     def _error(self, msg, **kwargs):
-        info = self._scan_info(**kwargs)
-        _bsmdoc_error(msg, **info)
-
-    def _scan_info(self, **kwargs):
+        _bsmdoc_error(msg, **self._scan_info(**kwargs))
+
+    def _scan_info(self, lineno=-1, inline=False):
+        # the args passed to the function block, which are also used to show
+        # the message (e.g., the file and line number). The function blocks
+        # take them as **kwargs, so a dict is still built for each call; it
+        # is only not copied again. The last one is kept, so BFunction can
+        # show the message.
         info = {'silent': not self.verbose,
                 'include': self.filename,
                 'cfg': self.config,
-                'indent': len(self._input_stack)}
-        info.update(kwargs)
-        # update the scan info for BFunction, so it can show the debug info
-        # (ugly, TODO)
-        BFunction.scan_info = dict(info)
-        self.config.scan_info = dict(info)
+                'indent': len(self._input_stack),
+                'lineno': lineno,
+                'inline': inline}
+        self.config.scan_info = info
         return info
 
     # lexer
+    def _escape(self, txt, words=False):
+        # call the built-in escape directly, unless it is overridden (e.g.,
+        # by the doc with \exec); if words is True, the overridden one is
+        # called for each word separated by space, as the merged words (see
+        # t_WORD) are still separate tokens to it
+        fun = self.interfaces.get('escape') or BFunction._interfaces.get('escape')
+        if fun is bsmdoc_escape:
+            if '<' in txt or '>' in txt:
+                return _bsmdoc_escape(txt)
+            return txt
+        if words and ' ' in txt:
+            return ' '.join([_bsmdoc_unbackslash(_bsmdoc_invoke(fun, w, (), {}))
+                             for w in txt.split(' ')])
+        return _bsmdoc_invoke(fun, txt, (), {})
+
     def t_error(self, t):
         self._error("illegal character '%s'" % (t.value[0]), lineno=t.lexer.lineno)
         t.lexer.skip(1)
 
-    def t_eof(self, t):
+    def restore_input(self, lexer):
         fn = self.pop_input()
         if fn:
-            t.lexer.input(fn['lexdata'])
-            t.lexer.lexpos = fn['lexpos']
-            t.lexer.lineno = fn['lineno']
+            lexer.input(fn['lexdata'])
+            lexer.lexpos = fn['lexpos']
+            lexer.lineno = fn['lineno']
             self.filename = fn['filename']
+            return True
+        return False
+
+    def t_eof(self, t):
+        if self.restore_input(t.lexer):
             return t.lexer.token()
         return None
 
@@ -343,11 +1029,18 @@ class BParse(object):
         filename = t.value.strip()
         filename = filename.replace('#include', '', 1).strip()
         kwargs = self._scan_info(lineno=t.lexer.lineno)
-        txt = BFunction().include(filename, **kwargs)
         t.lexer.lineno += t.value.count('\n')
+        if self.tree and BFunction.get('include') is bsmdoc_include and \
+           not os.path.isfile(_bsmdoc_path(filename)):
+            # the file may be generated by the blocks before it, which are
+            # not called until the tree is rendered
+            self._missing_includes.append((filename, dict(kwargs)))
+            return None
+        txt = BFunction.call('include', filename, **kwargs)
         if txt:
-            self.push_input(t, txt)
+            self.push_input(t, txt, filename)
             self.filename = filename
+            filename = _bsmdoc_path(filename)
             if os.path.isfile(filename):
                 self.config.set_updated(time.gmtime(os.path.getmtime(filename)), False)
             return t.lexer.token()
@@ -501,8 +1194,7 @@ class BParse(object):
 
     def t_link_WORD(self, t):
         r'(?:\\(\W)|(\!(?!\}))|(\%(?!\}))|(?<=\&)\#|[^ \$\%\!\n\|\{\}\[\]\\])+'
-        t.value = BFunction().escape(t.value)
-        t.value = re.sub(r'(\\)(.)', r'\2', t.value)
+        t.value = _bsmdoc_unbackslash(self._escape(t.value))
         return t
 
     # support the latex stylus command, e.g., \ref{}; and the command must have at
@@ -528,16 +1220,19 @@ class BParse(object):
 
     def t_escape_WORD(self, t):
         r'(?:\\(\W))+'
-        t.value = BFunction().escape(t.value)
-        t.value = re.sub(r'(\\)(.)', r'\2', t.value)
+        t.value = _bsmdoc_unbackslash(self._escape(t.value))
         t.type = 'WORD'
         return t
 
     # default state, ignore, '!}', '%}', '|', '[', ']', '{', '}', '\n', ' ', '#', '$'
+    # the words separated by spaces are merged into one token (the space run
+    # must be followed by a word), so the plain text is not split into many
+    # WORD/SPACE tokens
     def t_WORD(self, t):
-        r'(?:(\!(?!\}))|(\%(?!\}))|(?<=\&)\#|[^ \$\%\!\#\n\|\{\}\[\]\\])+'
-        t.value = BFunction().escape(t.value)
-        t.value = re.sub(r'(\\)(.)', r'\2', t.value)
+        r'(?:\!(?!\})|\%(?!\})|(?<=\&)\#|[^ \$\%\!\#\n\|\{\}\[\]\\])+(?:[ ][^\S\r\n]*(?=\S)(?:\!(?!\})|\%(?!\})|(?<=\&)\#|[^ \$\%\!\#\n\|\{\}\[\]\\])+)*'
+        # same as t_SPACE, the space run is replaced by a single space
+        t.value = self._space_re.sub(' ', t.value)
+        t.value = _bsmdoc_unbackslash(self._escape(t.value, True))
         return t
 
     """
@@ -615,20 +1310,34 @@ class BParse(object):
 
     def p_article(self, p):
         '''article : sections'''
-        self.html = p[1]
+        if self.tree:
+            self.root = self._join(p[1])
+        else:
+            self.html = self._join(p[1])
+
+    def _join(self, items):
+        # the repeated items (e.g., sections, text, line) are collected in a
+        # list, and only joined once when the enclosing rule is reduced;
+        # otherwise, the concatenation will be quadratic in the doc size
+        if self.tree:
+            return BSeq(items)
+        return ''.join(items)
 
     def p_sections_multi(self, p):
         '''sections : sections block'''
-        p[0] = p[1] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
 
     def p_sections_single(self, p):
         '''sections : block'''
-        p[0] = p[1]
+        p[0] = [p[1]]
 
     def p_heading(self, p):
         '''block : heading_start logicline'''
+        if self.tree:
+            p[0] = BHeading(p[1].strip(), p[2], p.lineno(1))
         # ignore the header level 7 or higher
-        if len(p[1].strip()) <= 6:
+        elif len(p[1].strip()) <= 6:
             p[0] = self.cmd_helper(['heading', p[1].strip()],
                                    p[2].strip(),
                                    lineno=p.lineno(1))
@@ -643,19 +1352,27 @@ class BParse(object):
 
     def p_block_paragraph(self, p):
         '''block : paragraph'''
+        if self.tree:
+            p[0] = p[1]
+        else:
+            p[0] = self._paragraph(p[1])
+
+    def _paragraph(self, txt):
         # add <P> tag to any text which is not in a function block and ended
         # with '\n
-        if not p[1].strip():
-            p[0] = ""
-        elif len(self.block_state) == self.heading_level and p[1].endswith('\n'):
-            p[0] = BFunction().tag(p[1].strip(), 'p') + '\n'
-        else:
-            p[0] = p[1]
+        if not txt.strip():
+            return ""
+        if len(self.block_state) == self.heading_level and txt.endswith('\n'):
+            return BFunction.call('tag', txt.strip(), 'p') + '\n'
+        return txt
 
     def p_paragraph_multiple(self, p):
         '''paragraph : text NEWPARAGRAPH'''
-        if p[1]:
-            p[0] = p[1] + '\n'
+        txt = self._join(p[1])
+        if self.tree:
+            p[0] = BParagraph(txt, True)
+        elif txt:
+            p[0] = txt + '\n'
             #'<p>%s</p>' %(p[1])
             #p[0] = bsmdoc_div(p[0], ['para'])
         else:
@@ -663,7 +1380,11 @@ class BParse(object):
 
     def p_paragraph_single(self, p):
         '''paragraph : text'''
-        p[0] = p[1]
+        txt = self._join(p[1])
+        if self.tree:
+            p[0] = BParagraph(txt, False)
+        else:
+            p[0] = txt
 
     def p_block_table(self, p):
         '''block : table'''
@@ -671,12 +1392,18 @@ class BParse(object):
 
     def p_table_title(self, p):
         '''table : tstart tbody TEND'''
-        p[0] = self.cmd_helper(["table"], p[2])
+        if self.tree:
+            p[0] = BTable(None, p[2], p.lineno(1))
+        else:
+            p[0] = self.cmd_helper(["table"], ''.join(p[2]))
         self.pop_block()
 
     def p_table(self, p):
         '''table : tstart thead tbody TEND'''
-        p[0] = self.cmd_helper(["table", p[2]], p[3])
+        if self.tree:
+            p[0] = BTable(p[2], p[3], p.lineno(1))
+        else:
+            p[0] = self.cmd_helper(["table", p[2]], ''.join(p[3]))
         self.pop_block()
 
     def p_table_start(self, p):
@@ -686,22 +1413,31 @@ class BParse(object):
 
     def p_tbody_multi(self, p):
         '''tbody : tbody trow'''
-        p[0] = p[1] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
 
     def p_tbody_single(self, p):
         '''tbody : trow'''
-        p[0] = p[1]
+        p[0] = [p[1]]
 
     def p_trow(self, p):
         '''trow : vtext TROW rowsep'''
-        row = ''.join([BFunction().tag(t.strip(), 'td') for t in p[1]])
-        p[0] = BFunction().tag(row, 'tr')
+        if self.tree:
+            p[0] = p[1]
+        else:
+            p[0] = self._table_row(p[1], 'td')
 
     def p_thead(self, p):
         '''thead : vtext THEAD rowsep'''
         # THEAD indicates the current row is header
-        tr = ''.join([BFunction().tag(t.strip(), 'th') for t in p[1]])
-        p[0] = BFunction().tag(tr, 'tr')
+        if self.tree:
+            p[0] = p[1]
+        else:
+            p[0] = self._table_row(p[1], 'th')
+
+    def _table_row(self, cells, tag):
+        row = ''.join([BFunction.call('tag', t.strip(), tag) for t in cells])
+        return BFunction.call('tag', row, 'tr')
 
     def p_rowsep(self, p):
         '''rowsep : rowsep SPACE
@@ -724,23 +1460,30 @@ class BParse(object):
 
     def p_block(self, p):
         '''block : bstart sections bend'''
-        p[0] = p[2]
+        if self.tree:
+            p[0] = BBlock([], self._join(p[2]), p.lineno(1))
+        else:
+            p[0] = self._join(p[2])
         self.pop_block()
 
     def p_block_arg(self, p):
         '''block : bstart blockargs sections bend'''
-        cmds = p[2]
-        p[0] = p[3]
-        for c in reversed(cmds):
-            if not c:
-                continue
-            p[0] = self.cmd_helper(c, p[0], lineno=p.lineno(2))
+        if self.tree:
+            p[0] = BBlock(p[2], self._join(p[3]), p.lineno(2))
+        else:
+            cmds = p[2]
+            p[0] = self._join(p[3])
+            for c in reversed(cmds):
+                if not c:
+                    continue
+                p[0] = self.cmd_helper(c, p[0], lineno=p.lineno(2))
 
         self.pop_block()
 
     def p_blockargs_multi(self, p):
         '''blockargs : blockargs vtext TCELL'''
-        p[0] = p[1] + [p[2]]
+        p[1].append(p[2])
+        p[0] = p[1]
 
     def p_blockargs_single(self, p):
         '''blockargs : vtext TCELL'''
@@ -748,16 +1491,24 @@ class BParse(object):
 
     def p_block_raw(self, p):
         '''block : RBLOCK'''
-        p[0] = p[1]
+        if self.tree:
+            p[0] = BRaw(p[1], p.lineno(1))
+        else:
+            p[0] = _bsmdoc_mark_raw(p[1])
 
     def p_block_eqn(self, p):
         '''block : EQUATION'''
-        p[0] = self.cmd_helper(["math"], p[1], lineno=p.lineno(1))
+        if self.tree:
+            p[0] = BEquation(p[1], False, p.lineno(1))
+        else:
+            p[0] = self.cmd_helper(["math"], p[1], lineno=p.lineno(1))
 
     def p_block_listbullet(self, p):
         '''block : listbullet'''
-        p[0] = p[1]
-        p[0] = self.cmd_helper(["listbullet"], p[1], lineno=p.lineno(1))
+        if self.tree:
+            p[0] = BList(p[1], p.lineno(1))
+        else:
+            p[0] = self.cmd_helper(["listbullet"], p[1], lineno=p.lineno(1))
 
     def p_listbullet_multi(self, p):
         '''listbullet : listbullet LISTBULLET logicline'''
@@ -772,45 +1523,61 @@ class BParse(object):
     def p_vtext_multi(self, p):
         '''vtext : vtext sections TCELL'''
         p[0] = p[1]
-        p[0].append(p[2].strip())
+        p[0].append(self._cell(p[2]))
 
     def p_vtext_single(self, p):
         '''vtext : sections TCELL'''
-        p[0] = [p[1].strip()]
+        p[0] = [self._cell(p[1])]
+
+    def _cell(self, sections):
+        if self.tree:
+            return self._join(sections)
+        return self._join(sections).strip()
 
     def p_text_multi(self, p):
         '''text : text logicline'''
-        p[0] = p[1] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
 
     def p_text_single(self, p):
         '''text : logicline'''
-        p[0] = p[1]
+        p[0] = [p[1]]
 
     def p_logicline(self, p):
         '''logicline : line
                      | bracetext'''
-        p[0] = p[1]
+        p[0] = self._join(p[1]) if isinstance(p[1], list) else p[1]
 
     def p_logicline_newline(self, p):
         '''logicline : line NEWLINE
                      | bracetext NEWLINE'''
-        p[0] = p[1].strip()
-        if p[0]:
-            p[0] = p[0] + '\n'
+        txt = self._join(p[1]) if isinstance(p[1], list) else p[1]
+        if self.tree:
+            p[0] = BLine(txt)
+        else:
+            p[0] = self._logicline(txt)
+
+    def _logicline(self, txt):
+        txt = txt.strip()
+        if txt:
+            txt = txt + '\n'
+        return txt
 
     def p_bracetext(self, p):
         '''bracetext : BRACEL sections BRACER'''
-        p[0] = p[2]
+        p[0] = self._join(p[2])
 
     def p_line_multi(self, p):
         '''line : line plaintext
                 | line inlineblock'''
-        p[0] = p[1] + p[2]
+        # plaintext is a list of words/spaces
+        p[1].append(''.join(p[2]) if isinstance(p[2], list) else p[2])
+        p[0] = p[1]
 
     def p_line(self, p):
         '''line : plaintext
                 | inlineblock'''
-        p[0] = p[1]
+        p[0] = [''.join(p[1]) if isinstance(p[1], list) else p[1]]
 
     def p_inlineblock_cmd(self, p):
         """inlineblock : CMD"""
@@ -818,66 +1585,91 @@ class BParse(object):
         if len(cmd) == 2:
             val = cmd
             val = val.replace("\\n", '<br>')
-            p[0] = re.sub(r'(\\)(.)', r'\2', val)
+            p[0] = _bsmdoc_unbackslash(val)
         else:
-            default = re.sub(r'(\\)(.)', r'\2', cmd)
-            p[0] = self.cmd_helper([cmd[1:]], '', default, p.lineno(1), True)
+            default = _bsmdoc_unbackslash(cmd)
+            if self.tree:
+                p[0] = BCommand(cmd[1:], [], '', p.lineno(1), default)
+            else:
+                p[0] = self.cmd_helper([cmd[1:]], '', default, p.lineno(1), True)
 
     def p_inlineblock_cmd_multi(self, p):
         """inlineblock : CMD bracetext"""
         cmd = p[1]
-        p[0] = self.cmd_helper([cmd[1:]],
-                               p[2],
-                               lineno=p.lineno(1),
-                               inline=True)
+        if self.tree:
+            p[0] = BCommand(cmd[1:], [], p[2], p.lineno(1))
+        else:
+            p[0] = self.cmd_helper([cmd[1:]],
+                                   p[2],
+                                   lineno=p.lineno(1),
+                                   inline=True)
 
     def p_inlineblock_cmd_args(self, p):
         """inlineblock : CMD BRACEL vtext sections BRACER"""
-        cmd = p[3]
-        cmd.insert(0, p[1][1:])
-        p[0] = self.cmd_helper(cmd, p[4], lineno=p.lineno(1), inline=True)
+        if self.tree:
+            p[0] = BCommand(p[1][1:], p[3], self._join(p[4]), p.lineno(1))
+        else:
+            cmd = p[3]
+            cmd.insert(0, p[1][1:])
+            p[0] = self.cmd_helper(cmd, self._join(p[4]), lineno=p.lineno(1), inline=True)
 
     def p_inlineblock_eqn(self, p):
         '''inlineblock : INLINEEQ'''
-        p[0] = self.cmd_helper(["math", "inline"], p[1], lineno=p.lineno(1))
+        if self.tree:
+            p[0] = BEquation(p[1], True, p.lineno(1))
+        else:
+            p[0] = self.cmd_helper(["math", "inline"], p[1], lineno=p.lineno(1))
 
     def check_anchor(self, anchor, lineno=-1):
         # internal anchor
         v = self.config['ANCHOR:%s' % anchor]
         if not v:
+            if self.config.can_defer():
+                return self.config.defer(self.check_anchor, anchor, lineno)
             v = anchor
             # do not find the anchor, wait for the 2nd scan
-            if not self.config.request_scan():
+            if self.config.single_pass or not self.config.request_scan():
                 self._warning("broken anchor '%s'" % v, lineno=lineno)
 
         return v
 
     def p_inlineblock_link_withname(self, p):
         '''inlineblock : BRACKETL sections TCELL sections BRACKETR'''
-        s = p[2].strip()
-        if s[0] == "#":
-            s = self.check_anchor(s[1:], lineno=p.lineno(2))
-        p[0] = BFunction().tag(p[4], 'a', 'href="%s"' % p[2])
+        if self.tree:
+            p[0] = BLink(self._join(p[2]), self._join(p[4]), p.lineno(2))
+        else:
+            p[0] = self._link(self._join(p[2]), self._join(p[4]), p.lineno(2))
 
     def p_inlineblock_link(self, p):
         '''inlineblock : BRACKETL sections BRACKETR'''
-        s = p[2].strip()
+        if self.tree:
+            p[0] = BLink(self._join(p[2]), None, p.lineno(2))
+        else:
+            p[0] = self._link(self._join(p[2]), None, p.lineno(2))
+
+    def _link(self, url, text=None, lineno=-1):
+        s = url.strip()
+        if text is not None:
+            if s[0] == "#":
+                self.check_anchor(s[1:], lineno=lineno)
+            return BFunction.call('tag', text, 'a', 'href="%s"' % url)
         v = s
         if s[0] == '#':
             # internal anchor
-            v = self.check_anchor(s[1:], lineno=p.lineno(2))
-        p[0] = BFunction().tag(v, 'a', 'href="%s"' % s)
+            v = self.check_anchor(s[1:], lineno=lineno)
+        return BFunction.call('tag', v, 'a', 'href="%s"' % s)
 
     def p_plaintext_multi(self, p):
         '''plaintext : plaintext WORD
                      | plaintext SPACE'''
-        p[0] = p[1] + p[2]
+        p[1].append(p[2])
+        p[0] = p[1]
 
     def p_plaintext_single(self, p):
         '''plaintext : WORD
                      | SPACE
                      | empty'''
-        p[0] = p[1]
+        p[0] = [p[1]]
 
     def p_empty(self, p):
         '''empty : '''
@@ -896,13 +1688,15 @@ class BParse(object):
         if not fun:
             # search global function bsmdoc_* to be compatible with previous
             # version
-            ldict = lex.get_caller_module_dict(1)
+            ldict = self.namespace or lex.get_caller_module_dict(1)
             fun = ldict.get('bsmdoc_' + cmds[0], None)
             if fun:
                 self._warning('use decorator @BFunction to define function "%s"' %
                               (cmds[0]), lineno=lineno)
         if fun and hasattr(fun, "__call__"):
-            return fun(data, *cmds[1:], **kwargs)
+            if type(data) is str and _raw_begin in data:
+                return _bsmdoc_invoke_raw(fun, data, cmds[1:], kwargs)
+            return _bsmdoc_invoke(fun, data, cmds[1:], kwargs)
 
         self._warning('undefined function block "%s".' % cmds[0], lineno=lineno)
 
@@ -911,24 +1705,291 @@ class BParse(object):
         return data
 
 
+class BNode(object):
+    """
+    base class of the document tree node, generated by BParse(tree=True).
+    The text in the node has been escaped by the lexer, and the function
+    blocks are not called until the tree is rendered by BRender.
+    """
+    __slots__ = ('lineno',)
+
+    def __init__(self, lineno=-1):
+        self.lineno = lineno
+
+    def __repr__(self):
+        fields = ', '.join([repr(getattr(self, k)) for k in type(self).__slots__])
+        return '%s(%s)' % (type(self).__name__, fields)
+
+
+class BSeq(BNode):
+    """sequence of nodes or text (e.g., sections, lines)"""
+    __slots__ = ('children',)
+
+    def __init__(self, children, lineno=-1):
+        super().__init__(lineno)
+        self.children = children
+
+
+class BHeading(BNode):
+    """heading block, level is the heading tag, e.g., '=='"""
+    __slots__ = ('level', 'body')
+
+    def __init__(self, level, body, lineno=-1):
+        super().__init__(lineno)
+        self.level = level
+        self.body = body
+
+
+class BParagraph(BNode):
+    """paragraph, newpara is True if it is ended with an empty line"""
+    __slots__ = ('body', 'newpara')
+
+    def __init__(self, body, newpara, lineno=-1):
+        super().__init__(lineno)
+        self.body = body
+        self.newpara = newpara
+
+
+class BLine(BNode):
+    """line ended with newline"""
+    __slots__ = ('body',)
+
+    def __init__(self, body, lineno=-1):
+        super().__init__(lineno)
+        self.body = body
+
+
+class BTable(BNode):
+    """table, head is a list of cells or None; rows is a list of rows"""
+    __slots__ = ('head', 'rows')
+
+    def __init__(self, head, rows, lineno=-1):
+        super().__init__(lineno)
+        self.head = head
+        self.rows = rows
+
+
+class BBlock(BNode):
+    """
+    function block, e.g., {!cmd1|arg||cmd2||body!}; args is a list of the
+    function block calls, each is a list of the name and arguments
+    """
+    __slots__ = ('args', 'body')
+
+    def __init__(self, args, body, lineno=-1):
+        super().__init__(lineno)
+        self.args = args
+        self.body = body
+
+
+class BCommand(BNode):
+    r"""inline function block, e.g., \cmd{arg|body}"""
+    __slots__ = ('name', 'args', 'body', 'default')
+
+    def __init__(self, name, args, body, lineno=-1, default=''):
+        super().__init__(lineno)
+        self.name = name
+        self.args = args
+        self.body = body
+        self.default = default
+
+
+class BRaw(BNode):
+    """raw block, i.e., {% %}"""
+    __slots__ = ('text',)
+
+    def __init__(self, text, lineno=-1):
+        super().__init__(lineno)
+        self.text = text
+
+
+class BEquation(BNode):
+    """equation block ($$ $$) or inline equation ($ $)"""
+    __slots__ = ('text', 'inline')
+
+    def __init__(self, text, inline, lineno=-1):
+        super().__init__(lineno)
+        self.text = text
+        self.inline = inline
+
+
+class BList(BNode):
+    """list, items is a list of [tag, node], where tag is [-*]+"""
+    __slots__ = ('items',)
+
+    def __init__(self, items, lineno=-1):
+        super().__init__(lineno)
+        self.items = items
+
+
+class BLink(BNode):
+    """link, e.g., [url|text]; text is None if not defined"""
+    __slots__ = ('url', 'text')
+
+    def __init__(self, url, text, lineno=-1):
+        super().__init__(lineno)
+        self.url = url
+        self.text = text
+
+
+class BRender(object):
+    """
+    class to render the document tree to html, with the function blocks
+    defined in the parser
+    """
+    def __init__(self, parser):
+        self.parser = parser
+
+    def render(self, node):
+        if isinstance(node, str):
+            return node
+        return self._render[type(node)](self, node)
+
+    def render_seq(self, node):
+        return ''.join([self.render(c) for c in node.children])
+
+    def render_heading(self, node):
+        parser = self.parser
+        parser.push_block({'block': 'heading', 'lineno': node.lineno})
+        body = self.render(node.body)
+        html = ""
+        # ignore the header level 7 or higher
+        if len(node.level) <= 6:
+            html = parser.cmd_helper(['heading', node.level], body.strip(), lineno=node.lineno)
+        parser.pop_block()
+        return html
+
+    def render_paragraph(self, node):
+        txt = self.render(node.body)
+        if node.newpara:
+            txt = txt + '\n' if txt else ''
+        return self.parser._paragraph(txt)
+
+    def render_line(self, node):
+        return self.parser._logicline(self.render(node.body))
+
+    def render_table(self, node):
+        parser = self.parser
+        parser.push_block({'block': 'table', 'lineno': node.lineno})
+        cmds = ['table']
+        if node.head is not None:
+            cmds.append(self._table_row(node.head, 'th'))
+        rows = ''.join([self._table_row(row, 'td') for row in node.rows])
+        html = parser.cmd_helper(cmds, rows)
+        parser.pop_block()
+        return html
+
+    def _table_row(self, cells, tag):
+        return self.parser._table_row([self.render(c).strip() for c in cells], tag)
+
+    def render_block(self, node):
+        parser = self.parser
+        parser.push_block({'block': 'fun', 'lineno': node.lineno})
+        cmds = [[self.render(a).strip() for a in args] for args in node.args]
+        html = self.render(node.body)
+        for c in reversed(cmds):
+            if not c:
+                continue
+            html = parser.cmd_helper(c, html, lineno=node.lineno)
+        parser.pop_block()
+        return html
+
+    def render_command(self, node):
+        cmds = [node.name] + [self.render(a).strip() for a in node.args]
+        return self.parser.cmd_helper(cmds, self.render(node.body), node.default,
+                                      node.lineno, True)
+
+    def render_raw(self, node):
+        return _bsmdoc_mark_raw(node.text)
+
+    def render_equation(self, node):
+        cmds = ['math', 'inline'] if node.inline else ['math']
+        return self.parser.cmd_helper(cmds, node.text, lineno=node.lineno)
+
+    def render_list(self, node):
+        items = [[tag, self.render(n)] for tag, n in node.items]
+        return self.parser.cmd_helper(['listbullet'], items, lineno=node.lineno)
+
+    def render_link(self, node):
+        url = self.render(node.url)
+        text = None
+        if node.text is not None:
+            text = self.render(node.text)
+        return self.parser._link(url, text, node.lineno)
+
+    _render = {
+        BSeq: render_seq,
+        BHeading: render_heading,
+        BParagraph: render_paragraph,
+        BLine: render_line,
+        BTable: render_table,
+        BBlock: render_block,
+        BCommand: render_command,
+        BRaw: render_raw,
+        BEquation: render_equation,
+        BList: render_list,
+        BLink: render_link,
+    }
+
+
+class _BScanInfo(object):
+    # BFunction.scan_info, the info of the current scan (e.g., file and line
+    # number) of the parser running in the current thread
+    def __get__(self, obj, cls):
+        parser = BFunction.parser()
+        if parser is None:
+            return {}
+        return parser.config.scan_info
+
+
 class BFunction(object):
+    # the global function blocks
     _interfaces = {}
-    scan_info = {}
+    # the parser running in the current thread
+    _local = threading.local()
+    scan_info = _BScanInfo()
 
     def __init__(self, cmd=None):
         self.cmd = cmd
 
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls, parser):
+        """
+        the function blocks defined within the scope are only visible to
+        the parser (e.g., the doc defines its own function blocks), so
+        multiple parsers can run at the same time (e.g., in different threads)
+        """
+        prev = getattr(cls._local, 'parser', None)
+        cls._local.parser = parser
+        try:
+            yield parser
+        finally:
+            cls._local.parser = prev
+
+    @classmethod
+    def parser(cls):
+        return getattr(cls._local, 'parser', None)
+
     @classmethod
     def get(cls, intf):
+        parser = getattr(cls._local, 'parser', None)
+        if parser is not None and intf in parser.interfaces:
+            return parser.interfaces[intf]
         return cls._interfaces.get(intf, None)
 
     @classmethod
     def get_all(cls):
-        return cls._interfaces
+        parser = cls.parser()
+        if parser is None:
+            return cls._interfaces
+        interfaces = dict(cls._interfaces)
+        interfaces.update(parser.interfaces)
+        return interfaces
 
     @classmethod
     def exists(cls, intf):
-        return cls._interfaces.get(intf, None)
+        return cls.get(intf)
 
     def __call__(self, intf):
         name = ""
@@ -940,15 +2001,23 @@ class BFunction(object):
         if not name:
             raise NameError('Name for function block is missing!')
 
-        if name in BFunction._interfaces and BFunction._interfaces[name].func_closure != intf:
+        fun = BFunction.get(name)
+        if fun and fun.func_closure != intf:
             # if interface(name) is to be overwritten by something different
             _bsmdoc_info('overwrite function block "%s"' % (name), **BFunction.scan_info)
 
+        parser = BFunction.parser()
+
         def wrap(data, *args, **kwargs):
             if hasattr(intf, '__call__'):
                 # parse the args from function block, and add it to kwargs
                 fun_args, fun_kwargs = _bsmdoc_parse_args(*args)
                 kwargs.update({'fun_args': fun_args, 'fun_kwargs': fun_kwargs})
+                if parser is not None:
+                    # the function defined by the doc may access the files
+                    # relative to the doc
+                    with _bsmdoc_cwd():
+                        return str(intf(data, *args, **kwargs))
                 return str(intf(data, *args, **kwargs))
             elif intf and isinstance(intf, six.string_types):
                 # it is defined as an alias (e.g., with \newfun{bsmdoc|CONTENT}),
@@ -960,7 +2029,13 @@ class BFunction(object):
             return ''
 
         wrap.func_closure = intf
-        BFunction._interfaces[name] = wrap
+        # the global function can be called without the wrapper, as it does
+        # not need to change the working directory
+        wrap.direct = intf if parser is None and hasattr(intf, '__call__') else None
+        if parser is not None:
+            parser.interfaces[name] = wrap
+        else:
+            BFunction._interfaces[name] = wrap
 
         return wrap
 
@@ -969,13 +2044,97 @@ class BFunction(object):
             return BFunction.get(intf)
         raise AttributeError('Undefined interface "%s"' % (intf))
 
+    @classmethod
+    def call(cls, intf, data, *args, **kwargs):
+        """
+        call the function block, same as BFunction().intf(data, *args,
+        **kwargs); but the global function (e.g., the built-in one) is called
+        directly if it is not overridden by the doc
+        """
+        fun = cls.get(intf)
+        if fun is None:
+            raise AttributeError('Undefined interface "%s"' % (intf))
+        return _bsmdoc_invoke(fun, data, args, kwargs)
+
+
+def _bsmdoc_invoke(fun, data, args, kwargs):
+    # call the function block fun (e.g., returned by BFunction.get)
+    intf = getattr(fun, 'direct', None)
+    if intf is None:
+        return fun(data, *args, **kwargs)
+    # not change kwargs, which may be kept by the caller (e.g., scan_info)
+    fun_args, fun_kwargs = _bsmdoc_parse_args(*args)
+    kwargs = dict(kwargs, fun_args=fun_args, fun_kwargs=fun_kwargs)
+    ret = intf(data, *args, **kwargs)
+    return ret if isinstance(ret, str) else str(ret)
+
+
+# the raw blocks ({% %}) are marked in the html when they are parsed, so
+# BMinify knows where they are; the marks are removed before the data is
+# passed to the function blocks, and from the html at the end of the parsing
+_raw_begin = '\ue002'
+_raw_end = '\ue003'
+_raw_re = re.compile('\ue002(.*?)\ue003', re.S)
+
+
+def _bsmdoc_mark_raw(txt):
+    # the whitespace around the raw block is not preserved
+    core = txt.strip()
+    if not core:
+        return txt
+    start = txt.find(core)
+    return txt[:start] + _raw_begin + core + _raw_end + txt[start + len(core):]
+
+
+def _bsmdoc_unmark_raw(txt):
+    # return the text without the marks, and the ranges of the raw blocks
+    pieces = []
+    ranges = []
+    pos = size = 0
+    for m in _raw_re.finditer(txt):
+        pieces.append(txt[pos:m.start()])
+        size += m.start() - pos
+        pieces.append(m.group(1))
+        ranges.append([size, size + len(m.group(1))])
+        size += len(m.group(1))
+        pos = m.end()
+    pieces.append(txt[pos:])
+    return ''.join(pieces), ranges
+
+
+def _bsmdoc_invoke_raw(fun, data, args, kwargs):
+    # call the function block with the data without the marks; if the data
+    # is in the output as it is (e.g., div), mark the raw blocks in the output
+    # again, so they are still preserved
+    data, ranges = _bsmdoc_unmark_raw(data)
+    ret = _bsmdoc_invoke(fun, data, args, kwargs)
+    core = data.strip()
+    start = ret.find(core) if core else -1
+    if start == -1:
+        return ret
+    offset = len(data) - len(data.lstrip()) - start
+    pieces = []
+    pos = start
+    for begin, end in ranges:
+        # the whitespace around the data may be stripped by the function
+        begin = max(begin - offset, start)
+        end = min(end - offset, start + len(core))
+        if begin >= end:
+            continue
+        pieces.append(ret[pos:begin])
+        pieces.append(_bsmdoc_mark_raw(ret[begin:end]))
+        pos = end
+    return ret[:start] + ''.join(pieces) + ret[pos:]
+
 
 @BFunction('include')
 def bsmdoc_include(data, **kwargs):
-    filename = data.strip()
+    filename = _bsmdoc_path(data.strip())
     if os.path.isfile(filename):
         return _bsmdoc_readfile(filename, **kwargs)
     else:
+        # the output will change once the file is created
+        _bsmdoc_depend(filename, None)
         _bsmdoc_error("can't not find %s" % filename, **kwargs)
     return ""
 
@@ -995,50 +2154,126 @@ def bsmdoc_makecontent(contents, **kwargs):
     call = []
     for c in contents:
         # the text has been parsed, so ignore the parsing here
-        txt = BFunction().tag(c[1], 'a', 'href="#%s"' % c[2])
+        txt = BFunction.call('tag', c[1], 'a', 'href="#%s"' % c[2])
         call.append(['-' * (c[0] - first_level + 1), txt])
-    return BFunction().listbullet(call)
+    return BFunction.call('listbullet', call)
+
+
+_unbackslash_re = re.compile(r'\\(.)')
+
+
+# str.replace is much faster than re.sub (or str.translate) to replace a
+# few characters
+def _bsmdoc_escape(txt):
+    return txt.replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _bsmdoc_unescape(txt):
+    return txt.replace('&lt;', '<').replace('&gt;', '>')
+
+
+def _bsmdoc_unbackslash(txt):
+    # remove the backslash of the escaped character, e.g., '\{' -> '{'
+    if '\\' in txt:
+        return _unbackslash_re.sub(r'\1', txt)
+    return txt
 
 
 @BFunction('escape')
 def bsmdoc_escape(data, *args, **kwargs):
-    txt = re.sub(r'(<)', r'&lt;', data)
-    txt = re.sub(r'(>)', r'&gt;', txt)
-    return txt
+    return _bsmdoc_escape(data)
 
 
 @BFunction('unescape')
 def bsmdoc_unescape(data, *args, **kwargs):
-    txt = re.sub(r'(&lt;)', r'<', data)
-    txt = re.sub(r'&gt;', r'>', txt)
-    return txt
+    return _bsmdoc_unescape(data)
+
+
+BMessage = collections.namedtuple('BMessage', ['level', 'msg', 'filename', 'lineno', 'indent'])
+
+
+class BLog(object):
+    """
+    class to record the warnings and errors of the doc. The same warning (e.g.,
+    from each scan) is only recorded and shown once. If deferred is True, the
+    warnings are shown by flush (e.g., after the doc is generated), instead of
+    when they occur.
+    """
+    def __init__(self, deferred=False):
+        self.deferred = deferred
+        self.messages = []
+        self._warnings = set()
+
+    def add(self, message):
+        """record the message, return False if it is a duplicated warning"""
+        if message.level == 'Warning':
+            if message in self._warnings:
+                return False
+            self._warnings.add(message)
+        self.messages.append(message)
+        return True
+
+    def warnings(self):
+        return [m for m in self.messages if m.level == 'Warning']
+
+    def errors(self):
+        return [m for m in self.messages if m.level == 'Error']
+
+    def flush(self):
+        """show the deferred warnings"""
+        if self.deferred:
+            warnings = [_bsmdoc_format(m) for m in self.warnings()]
+            if warnings:
+                click.echo('\n'.join(warnings))
+        self.clear()
+
+    def clear(self):
+        self.messages = []
+        self._warnings = set()
+
+
+def _bsmdoc_format(message):
+    info = message.level + ' ' + message.msg if message.level else message.msg
+    if message.lineno != -1:
+        info = "%3d: %s" % (message.lineno, info)
+    if message.filename:
+        info = ' '.join([click.format_filename(message.filename), info])
+    if message.indent:
+        info = '    ' * message.indent + info
+    return info
+
+
+def _bsmdoc_message(level, msg, kwargs):
+    return BMessage(level, msg, kwargs.get('filename', '') or kwargs.get('include', ''),
+                    kwargs.get('lineno', -1), kwargs.get('indent', 0))
 
 
 def _bsmdoc_info(msg, **kwargs):
-    lineno = kwargs.get('lineno', -1)
-    filename = kwargs.get('filename', '') or kwargs.get('include', '')
-    silent = kwargs.get('silent', False)
-    indent = kwargs.get('indent', 0)
-    if silent:
+    if kwargs.get('silent', False):
         return
-    info = msg
-    if lineno != -1:
-        info = "%3d: %s" % (lineno, info)
-    if filename:
-        info = ' '.join([click.format_filename(filename), info])
-    if indent:
-        info = '    ' * indent + info
-    click.echo(info)
+    click.echo(_bsmdoc_format(_bsmdoc_message('', msg, kwargs)))
+
+
+def _bsmdoc_log(level, msg, kwargs):
+    # record the message in the log of the doc, and show it if necessary
+    message = _bsmdoc_message(level, msg, kwargs)
+    parser = BFunction.parser()
+    if parser is not None:
+        if not parser.log.add(message):
+            return
+        # the error is always shown immediately, e.g., it may be followed by
+        # the traceback
+        if parser.log.deferred and level == 'Warning':
+            return
+    click.echo(_bsmdoc_format(message))
 
 
 def _bsmdoc_error(msg, **kwargs):
-    kwargs['silent'] = False
-    _bsmdoc_info('Error ' + msg, **kwargs)
+    _bsmdoc_log('Error', msg, kwargs)
 
 
 def _bsmdoc_warning(msg, **kwargs):
-    kwargs['silent'] = False
-    _bsmdoc_info('Warning ' + msg, **kwargs)
+    _bsmdoc_log('Warning', msg, kwargs)
 
 
 @BFunction('config')
@@ -1050,7 +2285,8 @@ def bsmdoc_config(data, *args, **kwargs):
         cfg.load(data)
     elif args[0] == 'bsmdoc_conf':
         _bsmdoc_info('read configuration from file "%s" ...' % data, **kwargs)
-        cfg.load(_bsmdoc_readfile(data, **kwargs))
+        filename = os.path.abspath(_bsmdoc_path(data.strip()))
+        cfg.load(_bsmdoc_readfile(filename, **kwargs), filename)
     else:
         if data.lower() in ['true', 'false']:
             data = data.lower() in ['true']
@@ -1072,18 +2308,18 @@ def bsmdoc_config(data, *args, **kwargs):
 
 @BFunction('label')
 def bsmdoc_label(data, *args, **kwargs):
-    return BFunction().config(data, 'v:label', *args, **kwargs)
+    return BFunction.call('config', data, 'v:label', *args, **kwargs)
 
 
 @BFunction('caption')
 def bsmdoc_caption(data, *args, **kwargs):
-    return BFunction().config(data, 'v:caption', *args, **kwargs)
+    return BFunction.call('config', data, 'v:caption', *args, **kwargs)
 
 
 # deal with the equation reference: \ref{} or \eqref{}
 @BFunction('eqref')
 def bsmdoc_eqref(data, *args, **kwargs):
-    BFunction().config('true', 'has_equation_ref', *args, **kwargs)
+    BFunction.call('config', 'true', 'has_equation_ref', *args, **kwargs)
     return "\\ref{%s}" % data
 
 
@@ -1094,40 +2330,318 @@ def bsmdoc_ref(data, *args, **kwargs):
     cfg = kwargs.get('cfg')
     v = cfg['ANCHOR:' + data]
     if v:
-        return BFunction().tag(v, 'a', 'href="#%s"' % data)
-    elif not cfg.request_scan() and not data.startswith('eq'):
+        return BFunction.call('tag', v, 'a', 'href="#%s"' % data)
+    elif cfg.can_defer():
+        return cfg.defer(bsmdoc_ref, data, *args, **kwargs)
+    elif (cfg.single_pass or not cfg.request_scan()) and not data.startswith('eq'):
         # not find the anchor for the 2nd scan
         _bsmdoc_warning("probably broken anchor '%s'" % data, **kwargs)
     # can not find the anchor, assume its a equation reference for now
-    return BFunction().eqref(data, *args, **kwargs)
+    return BFunction.call('eqref', data, *args, **kwargs)
+
+def _bsmdoc_path(filename):
+    # the files referred by the doc are relative to the doc, instead of the
+    # current working directory
+    parser = BFunction.parser()
+    if parser is None or not parser.path or os.path.isabs(filename):
+        return filename
+    return os.path.join(parser.path, filename)
+
+
+def _bsmdoc_depend(filename, digest):
+    # record the file read by the doc, so the html will be re-generated when
+    # the file is changed (BManifest)
+    parser = BFunction.parser()
+    if parser is not None:
+        parser.dependencies[filename] = digest
+
+
+def _bsmdoc_hash_file(filename):
+    # return the sha1 of the file, or None if it does not exist
+    try:
+        with open(filename, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+# the working directory is shared by all the threads, so it is only changed
+# with the lock held (see _bsmdoc_cwd)
+_cwd_lock = threading.RLock()
+
+
+@contextlib.contextmanager
+def _bsmdoc_cwd():
+    # the code from the doc (e.g., exec block) may access the files relative
+    # to the doc, so temporarily change the working directory to the doc
+    # folder. The code from the docs parsed in different threads is
+    # serialized by the lock; the rest of the parsing does not depend on the
+    # working directory (see _bsmdoc_path), so it still runs in parallel.
+    parser = BFunction.parser()
+    if parser is None:
+        yield
+        return
+    with _cwd_lock:
+        cwd = os.getcwd()
+        if not parser.path or parser.path == cwd:
+            yield
+            return
+        os.chdir(parser.path)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+
+
+def _bsmdoc_abspath(path):
+    # the working directory may be changed temporarily by the code from the
+    # doc in other threads
+    with _cwd_lock:
+        return os.path.abspath(path)
+
+
+def _bsmdoc_namespace():
+    # each parser has its own namespace to run the code, so the variables
+    # defined in one doc will not leak to the others
+    parser = BFunction.parser()
+    if parser is None:
+        return globals()
+    if parser.namespace is None:
+        parser.namespace = dict(globals())
+    return parser.namespace
+
 
 @BFunction('eval')
 def bsmdoc_eval(data, *args, **kwargs):
-    cfg = kwargs.get('cfg')
-    # check if it only needs to execute the code for the 1st scan
-    if args and args[0] == "firstRunOnly" and cfg.get_scan() > 1:
-        return ''
-    try:
-        return eval(data, globals())
-    except:
-        _bsmdoc_error("bsmdoc_eval('%s',%s)" % (data, args), **kwargs)
-        traceback.print_exc(file=sys.stdout)
-    return ''
+    return _bsmdoc_code(data, 'eval', *args, **kwargs)
 
 @BFunction('exec')
 def bsmdoc_exec(data, *args, **kwargs):
+    _bsmdoc_code(data, 'exec', *args, **kwargs)
+    return ''
+
+
+# the output of exec/eval block with 'cache' option
+exec_cache = BCache('exec')
+_code_executor = None
+_code_executor_lock = threading.Lock()
+
+
+def _bsmdoc_code(data, mode, *args, **kwargs):
+    """
+    run the code from exec/eval block, the options
+        firstRunOnly: only run the code in the 1st scan
+        cache: do not run the code again if the code and its inputs (the
+               files, and the variables it reads) are not changed, and its
+               outputs still exist; eval block returns the cached value, and
+               exec block restores the variables it defines
+        inputs=FILES: the files read by the code (separated by space)
+        outputs=FILES: the files generated by the code
+        async: run the code in a separate process, in parallel with the
+               parsing (once for all the scans); so the code can not access
+               the doc (e.g., define the function block)
+        timeout=SECONDS: the max time to run the async code
+    """
     cfg = kwargs.get('cfg')
+    fun_args, fun_kwargs = kwargs['fun_args'], kwargs['fun_kwargs']
+    name = "bsmdoc_%s('%s',%s)" % (mode, data, args)
     # check if it only needs to execute the code for the 1st scan
-    if args and args[0] == "firstRunOnly" and cfg.get_scan() > 1:
+    if 'firstRunOnly' in fun_args and cfg.get_scan() > 1:
         return ''
+    parser = BFunction.parser()
+    cwd = parser.path if parser is not None and parser.path else os.getcwd()
+    key = None
+    names = None
+    if 'cache' in fun_args:
+        inputs = _bsmdoc_code_files(fun_kwargs.get('inputs'))
+        outputs = _bsmdoc_code_files(fun_kwargs.get('outputs'))
+        names = _bsmdoc_code_names(data, mode)
+        # the variables read by the code are also its inputs; not cache the
+        # code if any of them can't be pickled
+        variables = _bsmdoc_code_variables(names, strict=True)
+        if variables is not None:
+            key = BCache.key(mode, data, cwd, [(f, _bsmdoc_hash_file(f)) for f in inputs],
+                             sorted(six.iteritems(variables)))
+            cached = exec_cache.get(key)
+            if cached is not None:
+                cached = json.loads(cached)
+                if all(_bsmdoc_hash_file(f) == h for f, h in six.iteritems(cached['outputs'])):
+                    _bsmdoc_info('%s block: use the cached output' % mode, **kwargs)
+                    # the variables defined or changed by the code
+                    _bsmdoc_code_restore(_bsmdoc_namespace(), cached['variables'])
+                    return cached['result']
+
+    def done(result, variables=None):
+        result = str(result)
+        if key is not None and variables is not None:
+            value = {'result': result,
+                     'outputs': {f: _bsmdoc_hash_file(f) for f in outputs},
+                     'variables': variables}
+            exec_cache.set(key, json.dumps(value))
+        return result
+
+    if 'async' in fun_args:
+        # the code is only run once for each doc, and its result is used by
+        # the following scans
+        jobs = parser.code_jobs if parser is not None else {}
+        job = (name, cwd)
+        if job not in jobs:
+            jobs[job] = _bsmdoc_code_executor().submit(_bsmdoc_code_process, mode, data, cwd,
+                                                       _bsmdoc_code_variables(),
+                                                       fun_kwargs.get('timeout'))
+        future = jobs[job]
+
+        def wait():
+            try:
+                # the async code can't change the namespace of the doc
+                return done(future.result(), {})
+            except Exception as e:
+                _bsmdoc_error(name, **kwargs)
+                click.echo(str(e))
+            return ''
+        # wait for the result at the end of the scan
+        ach = cfg.defer(wait)
+        return ach if mode == 'eval' else ''
     try:
-        exec(data, globals())
+        with _bsmdoc_cwd():
+            namespace = _bsmdoc_namespace()
+            if mode == 'eval':
+                return done(eval(data, namespace), {})
+            before = dict(namespace) if key is not None else None
+            exec(data, namespace)
+            changed = None
+            if key is not None:
+                # the variables defined, or may be changed (e.g., a list) by
+                # the code; not cache the code if it defines the functions or
+                # classes, which may also be used elsewhere (e.g., BFunction)
+                defined = [k for k, v in six.iteritems(namespace)
+                           if before.get(k, before) is not v]
+                if not any(isinstance(namespace[k], (types.FunctionType, type))
+                           for k in defined):
+                    changed = _bsmdoc_code_variables(set(defined) | names)
+            return done('', changed)
     except:
-        _bsmdoc_error("bsmdoc_exec('%s',%s)" % (data, args), **kwargs)
+        _bsmdoc_error(name, **kwargs)
         traceback.print_exc(file=sys.stdout)
     return ''
 
 
+def _bsmdoc_code_names(code, mode):
+    # the names used by the code (e.g., the variables read or assigned),
+    # including the ones in its functions/classes
+    try:
+        code = compile(code.lstrip(' \t') if mode == 'eval' else code, '<string>', mode)
+    except SyntaxError:
+        return set()
+
+    def walk(c):
+        names = set(c.co_names)
+        for const in c.co_consts:
+            if isinstance(const, types.CodeType):
+                names |= walk(const)
+        return names
+    return walk(code)
+
+
+def _bsmdoc_code_files(files):
+    # the files are separated by space, and relative to the doc
+    if not files:
+        return []
+    if isinstance(files, six.string_types):
+        files = files.split()
+    return [_bsmdoc_path(str(f)) for f in files]
+
+
+def _bsmdoc_code_executor():
+    # the threads to wait for the processes to run the code
+    global _code_executor
+    with _code_executor_lock:
+        if _code_executor is None:
+            _code_executor = ThreadPoolExecutor(os.cpu_count() or 1)
+        return _code_executor
+
+
+def _bsmdoc_code_variables(names=None, strict=False):
+    """
+    the variables defined by the doc (e.g., in the previous exec blocks),
+    which are sent to the async code, or saved in the cache. The modules are
+    sent by name, and the values can't be pickled (e.g., the functions
+    defined by the doc) are skipped; or return None if strict.
+        names: the names of the variables, default is all the variables
+    """
+    variables = {}
+    default = globals()
+    namespace = _bsmdoc_namespace()
+    if names is None:
+        names = list(namespace)
+    for k in names:
+        if k not in namespace or k.startswith('__') or default.get(k) is namespace[k]:
+            continue
+        v = namespace[k]
+        if isinstance(v, types.ModuleType):
+            variables[k] = (True, v.__name__)
+            continue
+        try:
+            variables[k] = (False, base64.b64encode(pickle.dumps(v)).decode())
+        except Exception:
+            if strict:
+                return None
+    return variables
+
+
+def _bsmdoc_code_restore(namespace, variables):
+    # add the variables from _bsmdoc_code_variables to the namespace
+    for k, (module, v) in six.iteritems(variables):
+        namespace[k] = importlib.import_module(v) if module else \
+                       pickle.loads(base64.b64decode(v))
+
+
+def _bsmdoc_code_process(mode, code, cwd, variables, timeout=None):
+    # run the code in a new process (instead of a process pool), so it can be
+    # terminated when timeout; and spawn (instead of fork) the process, as
+    # the parser may run in a thread, and the locks held by the other threads
+    # would be copied to the child
+    ctx = multiprocessing.get_context('spawn')
+    conn, child_conn = ctx.Pipe(False)
+    process = ctx.Process(target=_bsmdoc_code_worker,
+                          args=(mode, code, cwd, variables, child_conn), daemon=True)
+    process.start()
+    child_conn.close()
+    try:
+        if not conn.poll(timeout):
+            process.terminate()
+            raise TimeoutError('timeout after %s seconds' % timeout)
+        ok, result = conn.recv()
+    except EOFError:
+        ok, result = False, 'the process exits with %s' % process.exitcode
+    finally:
+        process.join()
+        conn.close()
+    if not ok:
+        raise RuntimeError(result)
+    return result
+
+
+def _bsmdoc_code_worker(mode, code, cwd, variables, conn):
+    try:
+        # the process only runs this code, so it is safe to change its
+        # working directory
+        os.chdir(cwd)
+        # same namespace as the code run by the parser (_bsmdoc_namespace)
+        namespace = dict(globals())
+        _bsmdoc_code_restore(namespace, variables)
+        if mode == 'eval':
+            result = str(eval(code, namespace))
+        else:
+            exec(code, namespace)
+            result = ''
+        conn.send((True, result))
+    except BaseException:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
 @BFunction('newfun')
 def bsmdoc_newfun(data, *args, **kwargs):
     if not args or len(args) != 1:
@@ -1149,7 +2663,7 @@ def bsmdoc_pre(data, *args, **kwargs):
     if args and 'newlineonly' in args:
         # only replace newline with '<br>'
         return "<br>\n".join(data.split("\n"))
-    return BFunction().tag(data, "pre")
+    return BFunction.call('tag', data, "pre")
 
 
 @BFunction('tag')
@@ -1204,11 +2718,11 @@ def _code_format(code, obeytabs=False, gobble=0, autogobble=False):
 def bsmdoc_math(data, *args, **kwargs):
     cfg = kwargs.get('cfg')
     cfg['has_math'] = True
-    eqn = BFunction().escape(data)
+    eqn = BFunction.call('escape', data)
     if args and args[0] == 'inline':
         return '\\({0}\\)'.format(eqn)
 
-    return BFunction().div('$$\n{0}\n$$'.format(_code_format(eqn, autogobble=True)),
+    return BFunction.call('div', '$$\n{0}\n$$'.format(_code_format(eqn, autogobble=True)),
                            'mathjax')
 
 
@@ -1218,7 +2732,7 @@ def bsmdoc_div(data, *args, **kwargs):
     if not args:
         _bsmdoc_warning('div block requires at least one argument', **kwargs)
         return data
-    return BFunction().tag(data, 'div', *args, **kwargs)
+    return BFunction.call('tag', data, 'div', *args, **kwargs)
 
 
 def _to_list(val) -> list:
@@ -1229,7 +2743,11 @@ def _to_list(val) -> list:
 
 def _to_literal(value):
     try:
-        return literal_eval(value.strip())
+        txt = value.strip()
+        if txt.isidentifier() and txt not in ('True', 'False', 'None'):
+            # a name (e.g., class name) is not a literal, no need to parse it
+            return value
+        return literal_eval(txt)
     except:
         # do not strip(), otherwise the space in data will be gone, e.g.,
         # self['image_numbering_prefix'] = 'Fig. '
@@ -1241,7 +2759,21 @@ def _bsmdoc_parse_args(*args):
     # for any arg in args, if '=' is in arg, i.e., 'key=value', and key is a
     # valid python identifier, it will be convert to {'key': 'value'}
     # otherwise arg is untouched
-
+    # the function blocks are usually called with the same args (e.g., \tag
+    # for each table cell), so the parsed args are cached
+    try:
+        opts, kwargs, mutable = _bsmdoc_parse_args_cached(args)
+    except TypeError:
+        # unhashable args
+        opts, kwargs, mutable = _bsmdoc_parse_args_cached.__wrapped__(args)
+    # the caller may change the values
+    if mutable:
+        return copy.deepcopy(list(opts)), copy.deepcopy(dict(kwargs))
+    return list(opts), dict(kwargs)
+
+
+@functools.lru_cache(maxsize=4096)
+def _bsmdoc_parse_args_cached(args):
     opts = []
     kwargs = {}
     for arg in args:
@@ -1254,7 +2786,8 @@ def _bsmdoc_parse_args(*args):
                 continue
         opts.append(_to_literal(arg))
 
-    return opts, kwargs
+    mutable = any(isinstance(v, (list, dict, set)) for v in opts + list(kwargs.values()))
+    return tuple(opts), tuple(kwargs.items()), mutable
 
 
 @BFunction('alias')
@@ -1284,25 +2817,61 @@ def bsmdoc_highlight(code, *args, **kwargs):
                         gobble=gobble,
                         autogobble=autogobble)
 
-    lexer = get_lexer_by_name(args[0], stripnl=False, tabsize=4)
     for key in ['obeytabs', 'gobble', 'autogobble']:
         opts.pop(key, None)
     if "cssclass" not in opts:
         opts['cssclass'] = 'syntax-inline' if kwargs.get('inline', False) else 'syntax'
+    code = BFunction.call('unescape', code)
+    options = sorted(opts.items())
+    key = BCache.key(code, args[0], options, pygments.__version__, __version__)
+    txt = highlight_cache.get(key)
+    if txt is not None:
+        return txt
+    lexer = _highlight_lexer(args[0])
     # forward all the other args to HtmlFormatter
-    formatter = HtmlFormatter(**opts)
+    formatter = _highlight_formatter(repr(options), opts)
     # pygments will replace '&' with '&amp;', which will make the unicode
     # (e.g., &#xNNNN) shown incorrectly.
-    txt = highlight(BFunction().unescape(code), lexer, formatter)
+    txt = highlight(code, lexer, formatter)
     txt = txt.replace('&amp;#x', '&#x')
     txt = txt.replace('&amp;lt;', '&lt;')
-    return txt.replace('&amp;gt', '&gt;')
+    txt = txt.replace('&amp;gt', '&gt;')
+    highlight_cache.set(key, txt)
+    return txt
+
+
+# the highlighted code, keyed by the code, lexer and formatter options
+highlight_cache = BCache('highlight')
+_highlight_lexers = {}
+_highlight_formatters = {}
+# the docs may be generated in multiple threads (e.g., BServer)
+_highlight_lock = threading.Lock()
+
+
+def _highlight_lexer(name):
+    # reuse the lexer and formatter, as they are expensive to create
+    with _highlight_lock:
+        if name not in _highlight_lexers:
+            _highlight_lexers[name] = get_lexer_by_name(name, stripnl=False, tabsize=4)
+        return _highlight_lexers[name]
+
+
+def _highlight_formatter(key, opts):
+    with _highlight_lock:
+        if key not in _highlight_formatters:
+            _highlight_formatters[key] = HtmlFormatter(**opts)
+        return _highlight_formatters[key]
 
 
 @BFunction('cite')
 def bsmdoc_cite(data, *args, **kwargs):
     cfg = kwargs.get('cfg')
     hide = args and args[0] == 'hide'
+    if cfg.can_defer():
+        # the index of the reference depends on the references cited before,
+        # which may be defined later
+        ach = cfg.defer(bsmdoc_cite, data, *args, **kwargs)
+        return '' if hide else ach
     ref = cfg.refs.get(data, '')
     ref_tag = 1  # the index of the reference
     cite_tag = 1  # the index of citation of the reference
@@ -1335,13 +2904,13 @@ def bsmdoc_cite(data, *args, **kwargs):
     cite_all = []
     for c in six.moves.range(1, cite_tag + 1):
         anchor = 'href="#%s%d"' % (cite_id_prefix, c)
-        cite_all.append(BFunction().tag('&#8617;', 'a', anchor))
-    fn = BFunction().tag(ref + ' ' + ' '.join(cite_all), 'div', 'id="%s"' % ref_id)
+        cite_all.append(BFunction.call('tag', '&#8617;', 'a', anchor))
+    fn = BFunction.call('tag', ref + ' ' + ' '.join(cite_all), 'div', 'id="%s"' % ref_id)
     cfg.cited[i][0] = fn
     ach = ""
     if not hide:
         cite_id = 'id="%s%d"' % (cite_id_prefix, cite_tag)
-        ach = BFunction().tag(ref_tag, 'a', cite_id, 'href="#%s"' % ref_id)
+        ach = BFunction.call('tag', ref_tag, 'a', cite_id, 'href="#%s"' % ref_id)
         ach = '[{0}]'.format(ach)
     return ach
 
@@ -1366,12 +2935,12 @@ def bsmdoc_footnote(data, *args, **kwargs):
     # the footnote id
     dec = 'footnote-%d' % tag
     # add the footnote to the list, which will show at the end of the page
-    data = data + ' ' + BFunction().tag('&#8617;', 'a', 'href="#%s"' % (src))
-    fn = BFunction().div(data, 'id="%s"' % dec)
+    data = data + ' ' + BFunction.call('tag', '&#8617;', 'a', 'href="#%s"' % (src))
+    fn = BFunction.call('div', data, 'id="%s"' % dec)
     cfg.footnotes.append(fn)
-    tag = BFunction().tag(tag, 'sup')
+    tag = BFunction.call('tag', tag, 'sup')
     cfg['ANCHOR:%s' % dec] = dec
-    return BFunction().tag(tag, 'a', 'id="%s"' % src, 'href="#%s"' % dec)
+    return BFunction.call('tag', tag, 'a', 'id="%s"' % src, 'href="#%s"' % dec)
 
 
 @BFunction('heading')
@@ -1412,7 +2981,7 @@ def bsmdoc_heading(data, *args, **kwargs):
     if label:
         cfg['ANCHOR:%s' % label] = pre
         label = 'id="%s"' % label
-    return BFunction().tag(txt, 'h%d' % level, label) + '\n'
+    return BFunction.call('tag', txt, 'h%d' % level, label) + '\n'
 
 
 def _bsmdoc_next_tag(sec, **kwargs):
@@ -1463,7 +3032,7 @@ def _bsmdoc_prepare_numbering(sec, label, **kwargs):
         cfg['ANCHOR:%s' % label] = num
         label = 'id="%s"' % label
     if tag:
-        tag = BFunction().tag(tag, 'span', 'tag')
+        tag = BFunction.call('tag', tag, 'span', 'tag')
     return tag, label
 
 
@@ -1472,7 +3041,7 @@ def bsmdoc_image(data, *args, **kwargs):
     data = data.strip()
     cfg = kwargs.get('cfg')
     inline = kwargs.get('inline', False)
-    txt = BFunction().tag('', 'img', 'src="%s"' % data, 'alt="%s"' % data, *args)
+    txt = BFunction.call('tag', '', 'img', 'src="%s"' % data, 'alt="%s"' % data, *args)
     if inline:
         return txt
     caption = cfg['v:caption']
@@ -1480,17 +3049,17 @@ def bsmdoc_image(data, *args, **kwargs):
 
     tag, label = _bsmdoc_prepare_numbering('image', label, **kwargs)
     if caption:
-        caption = BFunction().tag(tag + ' ' + caption, 'figcaption', "caption")
+        caption = BFunction.call('tag', tag + ' ' + caption, 'figcaption', "caption")
         txt = '\n'.join([txt, caption])
-    return BFunction().tag(txt, 'figure', label, 'figure')
+    return BFunction.call('tag', txt, 'figure', label, 'figure')
 
 
 @BFunction('video')
 def bsmdoc_video(data, *args, **kwargs):
     cfg = kwargs['cfg']
-    src = BFunction().tag("", 'source', 'src="%s"' % data)
+    src = BFunction.call('tag', "", 'source', 'src="%s"' % data)
     src += "\nYour browser does not support the video tag."
-    txt = BFunction().tag(src, 'video', '"controls"', *args)
+    txt = BFunction.call('tag', src, 'video', '"controls"', *args)
     caption = cfg['v:caption']
     label = cfg['v:label']
     # if cfg['video_numbering'], use the same numbering as image
@@ -1498,9 +3067,9 @@ def bsmdoc_video(data, *args, **kwargs):
 
     tag, label = _bsmdoc_prepare_numbering(sec, label, **kwargs)
     if caption:
-        caption = BFunction().tag(tag + ' ' + caption, 'div', 'caption')
+        caption = BFunction.call('tag', tag + ' ' + caption, 'div', 'caption')
         txt = '\n'.join([txt, caption])
-    return BFunction().tag(txt, 'div', label, 'video')
+    return BFunction.call('tag', txt, 'div', label, 'video')
 
 
 @BFunction('table')
@@ -1508,17 +3077,17 @@ def bsmdoc_table(data, *args, **kwargs):
     cfg = kwargs['cfg']
     head = ""
     if args:
-        head = BFunction().tag(args[0], 'thead')
+        head = BFunction.call('tag', args[0], 'thead')
     body = ""
     if data:
-        body = BFunction().tag(data, 'tbody')
+        body = BFunction.call('tag', data, 'tbody')
 
     label = cfg['v:label']
     caption = cfg['v:caption']
     tag, label = _bsmdoc_prepare_numbering('table', label, **kwargs)
     if caption:
-        caption = BFunction().tag(tag + ' ' + caption, 'caption')
-    tbl = BFunction().tag((caption + '\n ' + head + body).strip(), 'table', label)
+        caption = BFunction.call('tag', tag + ' ' + caption, 'caption')
+    tbl = BFunction.call('tag', (caption + '\n ' + head + body).strip(), 'table', label)
     return tbl
 
 
@@ -1530,7 +3099,7 @@ def bsmdoc_listbullet(data, *args, **kwargs):
     def listbullet(stack):
         # stack is a list of
         # [index in the parent, parent tag, tag, text]
-        c = '\n'.join([BFunction().tag(item[3], "li") for item in stack])
+        c = '\n'.join([BFunction.call('tag', item[3], "li") for item in stack])
         # only take care of the current level, i.e., leave the parent level to
         # parent
         level = stack[0][2][len(stack[0][1]):]
@@ -1538,7 +3107,7 @@ def bsmdoc_listbullet(data, *args, **kwargs):
             tag = 'ul'
             if j == r'*':
                 tag = 'ol'
-            c = BFunction().tag(c, tag)
+            c = BFunction.call('tag', c, tag)
         return c
 
     if not data:
@@ -1600,26 +3169,140 @@ def bsmdoc_anchor(data, *args, **kwargs):
     data = data.strip()
     cfg = kwargs.get('cfg')
     cfg['ANCHOR:%s' % data] = data
-    return BFunction().tag(BFunction().tag("&#x2693;", 'sup'), 'a', 'id="%s"' % data)
+    return BFunction.call('tag', BFunction.call('tag', "&#x2693;", 'sup'), 'a', 'id="%s"' % data)
+
+
+# add function block \__version__ = __version__
+BFunction('__version__')(__version__)
+
+
+# the text of the files read by the doc, so the same file (e.g., the one
+# included by multiple docs) is only read and decoded once;
+# (path, mtime, size, encoding) -> (sha1, encoding, text)
+_readfile_cache = collections.OrderedDict()
+_readfile_lock = threading.Lock()
+_readfile_cache_size = 256
+# the number of bytes used to detect the encoding
+_readfile_sample = 65536
+# the characters (other than latin-1) shown as html entity
+_entity_re = re.compile('[\u0100-\uffff]+')
+
+
+class _BEntity(dict):
+    # the translate table, filled on demand
+    def __missing__(self, c):
+        self[c] = '&#x%04x;' % c
+        return self[c]
+
+
+_entity_table = _BEntity()
+
+
+def _bsmdoc_decode(raw, encoding=None):
+    # return the text and its encoding
+    if not encoding:
+        if raw.startswith(codecs.BOM_UTF8):
+            encoding = 'utf-8-sig'
+        else:
+            try:
+                # ascii is also valid utf-8
+                return raw.decode('utf-8'), 'utf-8'
+            except UnicodeDecodeError:
+                pass
+            # encoding is not define, try to detect it
+            encoding = chardet.detect(raw[:_readfile_sample])['encoding'] or 'utf-8'
+    return raw.decode(encoding), encoding
+
+
+def _bsmdoc_text(txt):
+    # universal newlines
+    if '\r' in txt:
+        txt = txt.replace('\r\n', '\n').replace('\r', '\n')
+    if not txt.isascii():
+        txt = _entity_re.sub(lambda m: m.group(0).translate(_entity_table), txt)
+    return txt
 
 
 def _bsmdoc_readfile(filename, encoding=None, **kwargs):
-    if not encoding and filename != '-':
-        # encoding is not define, try to detect it
-        with open(filename.strip(), 'rb') as fp:
+    if filename == '-':
+        _bsmdoc_info("open \"%s\" with encoding \"%s\"" % (filename, encoding),
+                     **kwargs)
+        with click.open_file(filename, 'r', encoding=encoding) as fp:
+            return _bsmdoc_text(fp.read())
+
+    filename = filename.strip()
+    with open(filename, 'rb') as fp:
+        st = os.fstat(fp.fileno())
+        key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size, encoding)
+        with _readfile_lock:
+            cached = _readfile_cache.get(key)
+            if cached is not None:
+                _readfile_cache.move_to_end(key)
+        if cached is None:
             raw = fp.read()
-            encoding = chardet.detect(raw)['encoding']
-
+            txt, detected = _bsmdoc_decode(raw, encoding)
+            cached = (hashlib.sha1(raw).hexdigest(), detected, _bsmdoc_text(txt))
+            with _readfile_lock:
+                _readfile_cache[key] = cached
+                while len(_readfile_cache) > _readfile_cache_size:
+                    _readfile_cache.popitem(last=False)
+    digest, encoding, txt = cached
+    _bsmdoc_depend(filename, digest)
     _bsmdoc_info("open \"%s\" with encoding \"%s\"" % (filename, encoding),
                  **kwargs)
-    with click.open_file(filename, 'r', encoding=encoding) as fp:
-        txt = fp.read()
-        txt = txt.encode('unicode_escape').decode()
-        regexp = re.compile(r'\\u([a-zA-Z0-9]{4})', re.M + re.S)
-        txt = regexp.sub(r'&#x\1;', txt)
-        txt = txt.encode().decode('unicode_escape')
-        return txt
-    return ""
+    return txt
+
+
+def _bsmdoc_writefile(filename, fragments, encoding=None):
+    """
+    write the fragments (list of str) to the file, return False if the file
+    is not changed (and not written)
+    """
+    encoding = encoding or locale.getpreferredencoding(False)
+
+    def _encode():
+        # same as the file opened in text mode
+        encoder = codecs.getincrementalencoder(encoding)()
+        for h in fragments:
+            if os.linesep != '\n':
+                h = h.replace('\n', os.linesep)
+            yield encoder.encode(h)
+        yield encoder.encode('', final=True)
+
+    sha, size = hashlib.sha1(), 0
+    for b in _encode():
+        sha.update(b)
+        size += len(b)
+    try:
+        if os.path.getsize(filename) == size and _bsmdoc_hash_file(filename) == sha.hexdigest():
+            return False
+    except OSError:
+        pass
+    # write to a temporary file first, so the readers (e.g., the web server)
+    # will not see a partial file
+    tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as fp:
+            for b in _encode():
+                fp.write(b)
+        os.replace(tmp, filename)
+    except:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    return True
+
+
+def _bsmdoc_source_date():
+    # return SOURCE_DATE_EPOCH as struct_time, or None if not set
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if not epoch:
+        return None
+    try:
+        return time.gmtime(int(epoch))
+    except (ValueError, OverflowError, OSError):
+        _bsmdoc_warning('invalid SOURCE_DATE_EPOCH "%s"' % epoch)
+        return None
 
 
 # generate the html
@@ -1680,31 +3363,154 @@ content = <div class="footer-text"> Last updated %(UPDATED)s by
 
 class BDoc(object):
     """class to generate the html file"""
-    def __init__(self, lex_only=False, verbose=False):
+    def __init__(self, lex_only=False, verbose=False, single_pass=False, tree=False):
         self.verbose = verbose
         self.lex_only = lex_only
-        self.parser = BParse(verbose=self.verbose)
+        self.parser = BParse(verbose=self.verbose, single_pass=single_pass, tree=tree)
         self.cfg = None
         self.output_filename = ""
-        self.html = ""
-        self.html_text = ""
+        # the css/js files used by the html
+        self.assets = []
+        # the fragments of the html page (see html_text)
+        self.html = []
+        self._html_text = None
         self.html_body = ""
+        # whether the output file is changed by the last gen()
+        self.output_changed = False
+        # the parsed doc and its metadata, to assemble the page again with
+        # the new template (see rewrap)
+        self.page_state = None
+        # collapse the whitespace between the block-level tags in the html
+        # page (see BMinify), and the number of bytes saved by the last gen()
+        self.minify = False
+        self.minify_saved = 0
 
     def parse_string(self, text):
         return self.parser.run(text, lex_only=self.lex_only)
 
-    def parse(self, filename, encoding=None):
-        txt = _bsmdoc_readfile(filename, encoding, silent=not self.verbose)
-        return self.parser.run(txt, filename, self.lex_only)
-
-    def gen(self, filename, encoding=None, output=True):
-        html_body = self.parse(filename, encoding)
+    def parse(self, filename, encoding=None, path=''):
+        """
+        parse the doc
+            filename: the doc filename, relative to path
+            path: the folder of the doc; the files referred by the doc (e.g.,
+                  include) are relative to it, default is the current working
+                  directory; the code from the doc (e.g., exec block) runs
+                  with the working directory changed to it, so such code is
+                  serialized if the docs are parsed in multiple threads
+        """
+        # use the absolute path, as the code from the doc may change the
+        # working directory (e.g., _bsmdoc_cwd)
+        self.parser.reset()
+        self.parser.path = _bsmdoc_abspath(path) if path else ''
+        with BFunction.scope(self.parser):
+            txt = _bsmdoc_readfile(os.path.join(self.parser.path, filename), encoding,
+                                   silent=not self.verbose)
+            html = self.parser.run(txt, filename, self.lex_only)
+        cache = highlight_cache
+        if cache.hits or cache.misses:
+            _bsmdoc_info('highlight cache: %d hits, %d misses' % (cache.hits, cache.misses),
+                         silent=not self.verbose)
+        return html
+
+    def gen(self, filename, encoding=None, output=True, path=''):
+        # the function blocks defined in the doc are also used to generate
+        # the page (e.g., \tag)
+        with BFunction.scope(self.parser):
+            return self._gen(filename, encoding, output, path)
+
+    def _gen(self, filename, encoding, output, path):
+        self.output_changed = False
+        html_body = self.parse(filename, encoding, path)
         if html_body is None:
             return ""
 
         self.html_body = html_body
-        cfg = self.parser.config
+        return self._output(filename, encoding, output, path)
+
+    def rewrap(self, state, filename, encoding=None, output=True, path=''):
+        """
+        generate the html page from the doc state saved by the previous gen()
+        (see page_state) without parsing the doc again, e.g., when only the
+        template (header/footer, css/js) is changed.
+        Return None if the state can not be used, e.g., the doc defines its
+        own function blocks (which are not saved), or the configuration file
+        is changed other than the template.
+        """
+        if (not state or state.get('version') != __version__ or state.get('functions') or
+                'raw_ranges' not in state):
+            return None
+        with BFunction.scope(self.parser):
+            self.output_changed = False
+            self.parser.reset()
+            self.parser.path = _bsmdoc_abspath(path) if path else ''
+            self.parser.dependencies = dict(state['dependencies'])
+            if not self.parser.config.restore(state['config']):
+                return None
+            self.parser.contents = state['contents']
+            self.parser.raw_ranges = state['raw_ranges']
+            self.html_body = state['body']
+            return self._output(filename, encoding, output, path)
+
+    def _state(self):
+        # the parsed doc, which is enough to assemble the page again
+        return {'version': __version__,
+                'functions': sorted(self.parser.interfaces),
+                'dependencies': dict(self.parser.dependencies),
+                'contents': self.parser.contents,
+                'body': self.html_body,
+                'raw_ranges': self.parser.raw_ranges,
+                'config': self.parser.config.state()}
+
+    def _output(self, filename, encoding, output, path):
+        self.cfg = self.parser.config
+        self.page_state = self._state()
+        # the body has been fixed by the parser
+        body = self.html_body.strip()
+        self.html = self._page(filename, body)
+        if self.minify:
+            # the ranges of the raw blocks in the stripped body
+            lead = len(self.html_body) - len(self.html_body.lstrip())
+            ranges = [[max(b - lead, 0), min(e - lead, len(body))]
+                      for b, e in self.parser.raw_ranges]
+            minify = BMinify()
+            self.html = minify.run(self.html, body, ranges)
+            self.minify_saved = minify.saved
+        self._html_text = None
+        if filename == '-':
+            self.output_filename = filename
+        else:
+            self.output_filename = os.path.join(path, os.path.splitext(filename)[0] + '.html')
+        if not output:
+            return self.html_text
+        if self.output_filename == '-':
+            with click.open_file(self.output_filename, 'w', encoding=encoding) as fp:
+                for h in self.html:
+                    fp.write(h)
+            self.output_changed = True
+        else:
+            # the file is not touched if the html is not changed
+            output_filename = os.path.join(self.parser.path,
+                                           os.path.splitext(filename)[0] + '.html')
+            self.output_changed = _bsmdoc_writefile(output_filename, self.html, encoding)
+        return self.html_text
 
+    @property
+    def html_text(self):
+        """the html page, which is joined from the fragments on demand"""
+        if self._html_text is None:
+            self._html_text = ''.join(self.html)
+        return self._html_text
+
+    @html_text.setter
+    def html_text(self, text):
+        self._html_text = text
+
+    def _page(self, filename, body):
+        """
+        return the html page as a list of fragments; the body is one of the
+        fragments, so it is not copied to assemble the page
+        """
+        cfg = self.parser.config
         html = []
         html.append(cfg['html:begin'])
         # header
@@ -1719,12 +3525,11 @@ class BDoc(object):
         refjs = self.parser.config['has_equation_ref']
         jqueryjs = refjs
 
-        if cfg.config.has_section('ANCHOR'):
-            refs = ('mjx-eqn-', 'img-', 'video-', 'tbl-', 'footnote-', 'reference-')
-            for key in cfg.config.options('ANCHOR'):
-                if key.startswith(refs):
-                    refjs = jqueryjs = True
-                    break
+        refs = ('mjx-eqn-', 'img-', 'video-', 'tbl-', 'footnote-', 'reference-')
+        for key in cfg.anchors:
+            if key.startswith(refs):
+                refjs = jqueryjs = True
+                break
 
         if refjs:
             js += _to_list(cfg['header:bsmdoc_js'])
@@ -1736,12 +3541,13 @@ class BDoc(object):
             jqueryjs = True
         css += _to_list(cfg['css'])
         js += _to_list(cfg['js'])
+        self.assets = [x for x in css + js if isinstance(x, str) and x]
         for c in css:
             if not isinstance(c, str) or not c:
                 continue
             html.append(
-                BFunction().tag('', 'link', 'rel="stylesheet"', 'href="%s"' % c,
-                                'type="text/css"'))
+                BFunction.call('tag', '', 'link', 'rel="stylesheet"', 'href="%s"' % c,
+                               'type="text/css"'))
         if cfg['has_math']:
             html.append(cfg['header:mathjax'])
         if jqueryjs and cfg['header:jquery']:
@@ -1750,75 +3556,740 @@ class BDoc(object):
             if not isinstance(j, str) or not j:
                 continue
             html.append(
-                BFunction().tag('', 'script', 'type="text/javascript"',
-                                'language="javascript"', 'src="%s"' % j))
+                BFunction.call('tag', '', 'script', 'type="text/javascript"',
+                               'language="javascript"', 'src="%s"' % j))
         if cfg['title']:
-            html.append(BFunction().tag(cfg['title'], 'title'))
+            html.append(BFunction.call('tag', cfg['title'], 'title'))
         html.append(cfg['header:end'])
 
         # body
         html.append(cfg['body:begin'])
+        html.append('')
+        # the deferred function blocks may be referred in the configurations
+        # (e.g., doctitle)
+        page = [cfg.fixup('\n'.join(html))]
+        page += [cfg.fixup(h) if h is not body else h for h in self._article(body)]
+
+        html = ['']
+        # reference
+        if cfg.cited:
+            cites = [BFunction.call('tag', x[0], 'li') for x in cfg.cited]
+            cites = BFunction.call('tag', '\n'.join(cites), 'ol')
+            cites = BFunction.call('tag', cites, 'div', 'reference')
+            html.append(cites)
+
+        html.append(cfg['footer:begin'])
+        if cfg.footnotes:
+            foots = [BFunction.call('tag', x, 'li') for x in cfg.footnotes]
+            foots = BFunction.call('tag', '\n'.join(foots), 'ol')
+            foots = BFunction.call('tag', foots, 'div', 'footnote')
+            html.append(foots)
+
+        cfg["source"] = ''
+        if cfg['show_source']:
+            cfg["source"] = ' ' + BFunction.call('tag', '(source)', 'a', 'href="%s"' % filename)
+        html.append(cfg['footer:content'])
+        html.append(cfg['footer:end'])
+
+        html.append(cfg['body:end'])
+
+        html.append(cfg['html:end'])
+        page.append(cfg.fixup('\n'.join(html)))
+        return page
+
+    # the placeholder of the article content in body:content
+    _content_marker = '\ue002'
 
+    def _article(self, body):
+        """return the fragments of the body:content"""
+        cfg = self.parser.config
         # the body:content defines the main architecture of the body
-        article = []
         contents = ''
         if self.parser.config['show_table_of_contents']:
             contents = self.parser.contents
             if contents:
-                contents = BFunction().div("\n%s\n" % (contents.replace('%', '%%')), 'menu')
+                contents = BFunction.call('div', "\n%s\n" % (contents.replace('%', '%%')), 'menu')
 
         cfg['body:article_menu'] = contents
         title = self.parser.config['doctitle']
         subtitle = self.parser.config['subtitle']
         if title:
             if subtitle:
-                title = title + BFunction().div(subtitle, 'subtitle')
-            title = BFunction().div(title, 'toptitle').strip()
-            article.append(title)
+                title = title + BFunction.call('div', subtitle, 'subtitle')
+            title = BFunction.call('div', title, 'toptitle').strip()
         cfg['body:article_title'] = title
-        article.append(BFunction().div(html_body, 'content'))
-        cfg['body:article_content'] = html_body.replace('%', '%%').strip()
-        html_body = contents + BFunction().div('\n'.join(article), 'main').strip()
+        # the body is not interpolated by the configuration (which requires
+        # to escape '%' in the body), instead, the template is split by the
+        # placeholder of the body
+        cfg['body:article_content'] = self._content_marker
         try:
-            if cfg['body:content']:
-                html_body = cfg['body:content']
+            content = cfg['body:content']
         except:
             traceback.print_exc(file=sys.stdout)
+            content = ''
+        if content:
+            content = str(content).split(self._content_marker)
+            article = [content[0]]
+            for c in content[1:]:
+                article += [body, c]
+            return article
+        # same as
+        # div('\n'.join([title, div(body, 'content')]), 'main')
+        article = [contents + '<div class="main">\n']
+        if title:
+            article.append(title + '\n')
+        article[-1] += '<div class="content">\n'
+        return article + [body, '\n</div>\n</div>']
 
-        html.append(html_body)
 
-        # reference
-        if cfg.cited:
-            cites = [BFunction().tag(x[0], 'li') for x in cfg.cited]
-            cites = BFunction().tag('\n'.join(cites), 'ol')
-            cites = BFunction().tag(cites, 'div', 'reference')
-            html.append(cites)
+class BMinify(object):
+    """
+    class to collapse the insignificant whitespace between the block-level
+    tags (e.g., the indentation of the templates, the newlines between the
+    table cells) in the html page. The content of <pre> (e.g., the code from
+    Pygments), <textarea>, <script>, <style>, the equations (MathJax) and the
+    raw blocks ({% %}) is preserved.
+    It runs on the fragments of the page in order (see BDoc.html), so the
+    page is not joined to be minified.
+    """
+    _block_tags = frozenset([
+        '!doctype', 'html', 'head', 'body', 'meta', 'link', 'title', 'script', 'style', 'div',
+        'p', 'pre', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th', 'caption', 'colgroup',
+        'col', 'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section',
+        'article', 'nav', 'header', 'footer', 'main', 'aside', 'figure', 'figcaption',
+        'blockquote', 'hr', 'form', 'fieldset', 'legend', 'details', 'summary', 'noscript'])
+    _tag_re = re.compile(r'</?([a-z][a-z0-9]*|!doctype)[\s/>]', re.I)
+    # the preserved content (group 1) or the tag (group 5), and the
+    # whitespace (not including '&nbsp;') before the next tag; it is much
+    # faster to check the tag names in _sub than in the regex
+    _minify_re = re.compile(
+        r'(?=[<$\\])(?:(<(pre|textarea|script|style)(?=[\s/>]).*?</\2\s*>|\$\$.*?\$\$|'
+        r'\\\(.*?\\\))([ \t\r\n\f]+(?=</?([a-z][a-z0-9]*|!doctype)[\s/>]))?|'
+        r'(</?([a-z][a-z0-9]*|!doctype)(?=[\s/>])[^<>]*>)[ \t\r\n\f]+'
+        r'(?=</?([a-z][a-z0-9]*|!doctype)[\s/>]))', re.S | re.I)
+    _space = ' \t\r\n\f'
 
-        html.append(cfg['footer:begin'])
-        if cfg.footnotes:
-            foots = [BFunction().tag(x, 'li') for x in cfg.footnotes]
-            foots = BFunction().tag('\n'.join(foots), 'ol')
-            foots = BFunction().tag(foots, 'div', 'footnote')
-            html.append(foots)
+    def __init__(self):
+        # the size of the input, and the number of bytes saved
+        self.size = 0
+        self.saved = 0
+        # the whitespace at the end of the previous fragment, and whether it
+        # follows a block-level tag
+        self._pending = ''
+        self._block = False
+
+    def run(self, fragments, body=None, raw=()):
+        """
+        return the minified fragments; raw is the ranges ([start, end], in
+        order) of the raw blocks in body, which are preserved
+        """
+        page = []
+        for h in fragments:
+            if h is body and raw:
+                page.append(''.join(self._minify(t, keep) for t, keep in self._split(h, raw)))
+            else:
+                page.append(self._minify(h, False))
+        if page:
+            page[-1] += self._pending
+            self._pending = ''
+        self.saved = self.size - sum(len(h) for h in page)
+        return page
+
+    @staticmethod
+    def _split(txt, raw):
+        # split txt to [(text, whether it is a raw block)]
+        pos = 0
+        for start, end in raw:
+            if start >= end:
+                continue
+            yield txt[pos:start], False
+            yield txt[start:end], True
+            pos = end
+        yield txt[pos:], False
+
+    def _minify(self, txt, keep):
+        self.size += len(txt)
+        if not keep:
+            txt = self._minify_re.sub(self._sub, txt)
+        # the whitespace between the fragments
+        stripped = txt if keep else txt.lstrip(self._space)
+        if not stripped:
+            self._pending += txt
+            return ''
+        pending = self._pending + txt[:len(txt) - len(stripped)]
+        if pending and not (self._block and self._is_block(stripped, 0)):
+            stripped = pending + stripped
+        txt = stripped
+        self._pending = ''
+        if not keep:
+            stripped = txt.rstrip(self._space)
+            self._pending = txt[len(stripped):]
+            txt = stripped
+        self._block = txt.endswith('>') and self._is_block(txt, txt.rfind('<'))
+        return txt
 
-        cfg["source"] = ''
-        if cfg['show_source']:
-            cfg["source"] = ' ' + BFunction().tag('(source)', 'a', 'href="%s"' % filename)
-        html.append(cfg['footer:content'])
-        html.append(cfg['footer:end'])
+    @classmethod
+    def _sub(cls, m):
+        # fetch all groups at once, it is called for each tag
+        keep, tag, space, end, start, name, following = m.groups()
+        blocks = cls._block_tags
+        if keep is not None:
+            if space and tag and tag.lower() in blocks and end.lower() in blocks:
+                return keep
+            return m.group(0)
+        if name.lower() in blocks and following.lower() in blocks:
+            return start
+        return m.group(0)
 
-        html.append(cfg['body:end'])
+    @classmethod
+    def _is_block(cls, txt, pos):
+        # whether txt[pos:] starts with a block-level tag
+        m = cls._tag_re.match(txt, pos) if pos >= 0 else None
+        return m is not None and m.group(1).lower() in cls._block_tags
 
-        html.append(cfg['html:end'])
 
-        self.cfg = cfg
-        self.html = html
-        self.html_text = '\n'.join(html)
-        if filename == '-':
-            self.output_filename = filename
+class BManifest(object):
+    """
+    class to record the inputs of the generated html file (e.g., the doc, the
+    included files, the configuration files and bsmdoc version), so the html
+    file is only re-generated when any of them is changed.
+    The files accessed by the code in exec/eval block are not tracked.
+    The parsed doc is also saved (see BDoc.page_state), so if only the
+    configuration files are changed, the page may be assembled again without
+    parsing the doc (see BDoc.rewrap).
+    """
+    folder = '.bsmdoc'
+
+    def __init__(self, filename, path='', options=None):
+        # filename is relative to path (the folder of the doc)
+        self.filename = filename
+        self.path = path
+        self.options = options or {}
+        self.manifest_filename = os.path.join(path, self.folder, filename + '.json')
+        self.page_filename = os.path.join(path, self.folder, filename + '.page.json')
+        # set by outdated(), True if only the configuration files are changed
+        self.rewrap = False
+
+    def load(self):
+        try:
+            with open(self.manifest_filename, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def load_page(self):
+        """return the parsed doc saved by save(), or None"""
+        try:
+            with open(self.page_filename, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def outdated(self):
+        """return the reason to re-generate the html, or '' if it is up to date"""
+        self.rewrap = False
+        manifest = self.load()
+        if not manifest:
+            return 'no manifest'
+        if manifest.get('version') != __version__:
+            return 'bsmdoc version changed (%s -> %s)' % (manifest.get('version'), __version__)
+        if manifest.get('options') != self.options:
+            return 'options changed'
+        output = os.path.join(self.path, manifest.get('output', ''))
+        if not os.path.isfile(output):
+            return '"%s" is missing' % output
+        configs = set(manifest.get('configs', []))
+        changed = []
+        for name, digest in sorted(six.iteritems(manifest.get('inputs', {}))):
+            current = _bsmdoc_hash_file(os.path.join(self.path, name))
+            if current != digest:
+                if digest is None:
+                    return '"%s" is created' % name
+                if current is None:
+                    return '"%s" is removed' % name
+                if name not in configs:
+                    return '"%s" is changed' % name
+                changed.append(name)
+        if changed:
+            self.rewrap = True
+            return '"%s" is changed' % changed[0]
+        return ''
+
+    def save(self, doc):
+        """save the inputs of the html generated by doc (BDoc)"""
+        base = self.path or '.'
+        inputs = {os.path.relpath(k, base): v for k, v in six.iteritems(doc.parser.dependencies)}
+        # the configuration files, which may only change the template
+        configs = [t[1] for t in doc.page_state['config']['templates'] if t[0] == 'file']
+        manifest = {'version': __version__,
+                    'options': self.options,
+                    'output': os.path.relpath(doc.output_filename, base),
+                    'inputs': inputs,
+                    'configs': sorted(set(os.path.relpath(c, base) for c in configs))}
+        folder = os.path.dirname(self.manifest_filename)
+        try:
+            # serialize first (e.g., the doc may set a value can't be saved
+            # in json), so the files are not written partially; and the
+            # manifest is written after the page state it refers to
+            page = json.dumps(doc.page_state, separators=(',', ':'))
+            manifest = json.dumps(manifest, indent=1, sort_keys=True)
+            os.makedirs(folder, exist_ok=True)
+            _bsmdoc_writefile(self.page_filename, [page], 'utf-8')
+            _bsmdoc_writefile(self.manifest_filename, [manifest], 'utf-8')
+        except (IOError, OSError, TypeError, ValueError):
+            _bsmdoc_warning('failed to save "%s"' % self.manifest_filename)
+            # the html will be generated again next time
+            try:
+                os.remove(self.manifest_filename)
+            except OSError:
+                pass
+
+
+class BGzip(object):
+    """
+    class to write the pre-compressed file (e.g., main.html.gz) next to the
+    file, for static hosting (e.g., nginx gzip_static). The files are
+    compressed in the worker threads (zlib releases the GIL), so it overlaps
+    with generating the next doc. The .gz file has the same mtime as the file,
+    so it is only compressed again when the file is changed.
+    """
+    def __init__(self, level=9, jobs=0):
+        self.level = level
+        self.jobs = jobs or os.cpu_count() or 1
+        # the number of files compressed, or skipped as the .gz file is up to date
+        self.compressed = 0
+        self.skipped = 0
+        self._pool = None
+        self._futures = []
+
+    def submit(self, filename):
+        """compress the file in the worker thread"""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.jobs)
+        self._futures.append(self._pool.submit(self._compress, filename))
+
+    def _compress(self, filename):
+        # return False if the .gz file is up to date
+        st = os.stat(filename)
+        output = filename + '.gz'
+        try:
+            if os.stat(output).st_mtime_ns == st.st_mtime_ns:
+                return False
+        except OSError:
+            pass
+        with open(filename, 'rb') as fp:
+            # no timestamp in the header, so the output is reproducible
+            data = gzip.compress(fp.read(), self.level, mtime=0)
+        # write to a temporary file first, so the web server will not see a
+        # partial file
+        tmp = '%s.%d.%d.tmp' % (output, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp, output)
+        except:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+        return True
+
+    def wait(self):
+        """wait for the submitted files, return the number of failures"""
+        failed = 0
+        for future in self._futures:
+            try:
+                if future.result():
+                    self.compressed += 1
+                else:
+                    self.skipped += 1
+            except (IOError, OSError) as e:
+                _bsmdoc_error('failed to compress the file: %s' % e)
+                failed += 1
+        self._futures = []
+        return failed
+
+    def close(self):
+        """wait for the submitted files and stop the worker threads"""
+        failed = self.wait()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return failed
+
+
+class BWatch(object):
+    """
+    class to watch the docs, and re-generate the html files when their inputs
+    (e.g., the doc, the included files, the configuration files) are changed.
+    Each doc keeps its own BDoc, so the parser is reused for each build.
+    """
+    def __init__(self, files, encoding=None, single_pass=False, verbose=False):
+        self.files = list(files)
+        self.encoding = encoding
+        self.single_pass = single_pass
+        self.verbose = verbose
+        self.docs = {}
+        # the files to be watched for each doc, {doc: {filename: stat}}
+        self.inputs = {}
+        self.assets = {}
+
+    @staticmethod
+    def _stat(filename):
+        try:
+            st = os.stat(filename)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _manifest(self, filename):
+        path, name = os.path.split(filename)
+        return BManifest(name, path, {'encoding': self.encoding})
+
+    def build(self, filename, force=False):
+        """
+        generate the html for the doc if necessary, and return the reason
+        ('' if it is up to date)
+        """
+        manifest = self._manifest(filename)
+        reason = 'forced' if force else manifest.outdated()
+        path = manifest.path
+        # watch the doc itself, in case it fails to generate
+        self.inputs.setdefault(filename, {filename: self._stat(filename)})
+        if reason:
+            doc = self.docs.get(filename)
+            if doc is None:
+                doc = self.docs[filename] = BDoc(False, self.verbose, self.single_pass)
+            if manifest.rewrap and doc.rewrap(manifest.load_page(), manifest.filename,
+                                              self.encoding, True, path):
+                reason += ' (template only)'
+            else:
+                doc.gen(manifest.filename, self.encoding, True, path)
+            manifest.save(doc)
+            inputs = list(doc.parser.dependencies)
+            assets = [os.path.join(path, a) for a in doc.assets]
         else:
-            self.output_filename = os.path.splitext(filename)[0] + '.html'
-        if output:
-            with click.open_file(self.output_filename, 'w', encoding=encoding) as fp:
-                fp.write(self.html_text)
-        return self.html_text
+            # the html is up to date, watch the inputs from the manifest
+            inputs = [os.path.join(path, f) for f in manifest.load().get('inputs', {})]
+            assets = []
+        self.inputs[filename] = {f: self._stat(f) for f in inputs}
+        self.assets[filename] = {f: self._stat(f) for f in assets if os.path.isfile(f)}
+        return reason
+
+    def _changed(self, watched):
+        # return the changed files, and update their stat
+        changed = []
+        for f, st in six.iteritems(watched):
+            current = self._stat(f)
+            if current != st:
+                watched[f] = current
+                changed.append(f)
+        return changed
+
+    def changes(self):
+        """return the docs whose inputs are changed, and the changed assets"""
+        docs, assets = set(), set()
+        for filename in self.files:
+            if self._changed(self.inputs.get(filename, {})):
+                docs.add(filename)
+            assets.update(self._changed(self.assets.get(filename, {})))
+        return docs, assets
+
+    def step(self, debounce=0.0):
+        """
+        check the changes and re-generate the affected html; return the
+        re-generated docs and the changed assets
+        """
+        docs, assets = self.changes()
+        if not docs and not assets:
+            return [], []
+        # wait until the files are quiet (e.g., editor saves a file in
+        # several writes)
+        while debounce > 0:
+            time.sleep(debounce)
+            more_docs, more_assets = self.changes()
+            if not more_docs and not more_assets:
+                break
+            docs |= more_docs
+            assets |= more_assets
+        rebuilt = []
+        for filename in sorted(docs):
+            mtime = max([st[0] for st in self.inputs[filename].values() if st] or [0])
+            start = time.time()
+            try:
+                self.build(filename, force=True)
+            except:
+                traceback.print_exc(file=sys.stdout)
+                continue
+            end = time.time()
+            _bsmdoc_info('"%s" is re-generated in %.0f ms (%.0f ms after the change)' %
+                         (filename, (end - start) * 1e3, max(end - mtime / 1e9, 0) * 1e3))
+            rebuilt.append(filename)
+        for f in sorted(assets):
+            _bsmdoc_info('"%s" is changed' % f)
+        return rebuilt, sorted(assets)
+
+    def run(self, interval=0.5, debounce=0.2, callback=None):
+        """watch the docs until interrupted"""
+        for filename in self.files:
+            try:
+                reason = self.build(filename)
+                if reason:
+                    _bsmdoc_info('"%s" is generated (%s)' % (filename, reason))
+            except:
+                traceback.print_exc(file=sys.stdout)
+        _bsmdoc_info('watching %d file(s), press Ctrl+C to stop' % len(self.files))
+        while True:
+            rebuilt, assets = self.step(debounce)
+            if callback and (rebuilt or assets):
+                callback(rebuilt, assets)
+            time.sleep(interval)
+
+
+class BServer(object):
+    """
+    class to serve the folder for preview. The html is generated from the
+    doc (e.g., index.html from index.bsmdoc) on request, and cached by the
+    mtime and size of its inputs; the opened pages are reloaded when the inputs are
+    changed.
+    """
+    events_path = '/__bsmdoc__/events'
+    # the page to reload is sent as the query
+    reload_script = ('<script>new EventSource("%s?" + encodeURIComponent(location.pathname))'
+                     '.onmessage = function() { location.reload(); };</script>' % events_path)
+
+    def __init__(self, folder='.', encoding=None, single_pass=False, verbose=False,
+                 cache_size=32):
+        self.folder = os.path.realpath(folder)
+        self.encoding = encoding
+        self.single_pass = single_pass
+        self.verbose = verbose
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        # the generated html, {(doc, inputs stat): html}
+        self._cache = collections.OrderedDict()
+        # the inputs of each doc from its last generation
+        self._inputs = {}
+        # the files (inputs and css/js) to trigger the reload, {doc: {filename: stat}}
+        self._watched = {}
+        self._docs = {}
+        # _cache, _inputs, _watched, _docs and _pending are guarded by _lock
+        self._lock = threading.Lock()
+        # the html is generated in separate threads, so the server can
+        # still respond to other requests (e.g., css/js files)
+        self._executor = ThreadPoolExecutor(os.cpu_count() or 1)
+        self._pending = {}
+        self._changed = threading.Condition()
+        # the version of each doc, which is increased when its files are
+        # changed, so only its pages are reloaded
+        self._versions = {}
+
+    def source(self, path):
+        """return the doc to generate the html for the url path, or None"""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        filename = os.path.realpath(os.path.join(self.folder, path.lstrip('/')))
+        # not the sibling folders with the same prefix (e.g., /srv/docs-private)
+        if os.path.commonpath([self.folder, filename]) != self.folder:
+            return None
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, 'index.html')
+        base, ext = os.path.splitext(filename)
+        if ext.lower() != '.html' or not os.path.isfile(base + '.bsmdoc'):
+            return None
+        return base + '.bsmdoc'
+
+    @staticmethod
+    def hidden(path):
+        """return True if the url path is not served (e.g., the manifest folder)"""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+        return BManifest.folder in path.split('/')
+
+    @staticmethod
+    def _key(filename, inputs):
+        # same as _bsmdoc_readfile, the file is assumed to be unchanged if
+        # its mtime and size are not changed
+        if inputs is None:
+            return None
+        return (filename, tuple((f, BWatch._stat(f)) for f in inputs))
+
+    def render(self, filename):
+        """return the html of the doc (filename)"""
+        with self._lock:
+            inputs = self._inputs.get(filename)
+        # check the inputs without the lock, so the requests to the other docs
+        # are not blocked
+        key = self._key(filename, inputs)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses += 1
+            # the requests to the same doc share the generation
+            future = self._pending.get(filename)
+            if future is None:
+                future = self._executor.submit(self._render, filename)
+                self._pending[filename] = future
+        return future.result()
+
+    def _render(self, filename):
+        try:
+            path, name = os.path.split(filename)
+            with self._lock:
+                doc = self._docs.get(filename)
+                if doc is None:
+                    doc = self._docs[filename] = BDoc(False, self.verbose, self.single_pass)
+            # the doc is only generated by one thread at a time (_pending)
+            start = time.time()
+            html = doc.gen(name, self.encoding, False, path)
+            _bsmdoc_info('"%s" is generated in %.0f ms' %
+                         (os.path.relpath(filename, self.folder), (time.time() - start) * 1e3))
+            dependencies = dict(doc.parser.dependencies)
+            inputs = sorted(dependencies)
+            assets = [os.path.join(path, a) for a in doc.assets]
+            key = self._key(filename, inputs)
+            watched = {f: BWatch._stat(f) for f in inputs + assets}
+            # the inputs may be changed after they are read, check them after
+            # the stamps (key) are taken, so the stale html is not cached
+            stale = [f for f, digest in six.iteritems(dependencies)
+                     if _bsmdoc_hash_file(f) != digest]
+            for f in stale:
+                # not the current stamp, so the page is reloaded by poll
+                watched[f] = (-1, -1)
+            with self._lock:
+                self._inputs[filename] = inputs
+                self._watched[filename] = watched
+                if not stale:
+                    self._cache[key] = html
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return html
+        finally:
+            with self._lock:
+                self._pending.pop(filename, None)
+
+    def poll(self):
+        """check the files of the generated pages, return True if any is changed"""
+        changed = []
+        docs = set()
+        with self._lock:
+            for filename, watched in six.iteritems(self._watched):
+                for f, st in six.iteritems(watched):
+                    current = BWatch._stat(f)
+                    if current != st:
+                        watched[f] = current
+                        changed.append(f)
+                        docs.add(filename)
+        if changed:
+            for f in sorted(set(changed)):
+                _bsmdoc_info('"%s" is changed' % os.path.relpath(f, self.folder))
+            with self._changed:
+                for filename in docs:
+                    self._versions[filename] = self._versions.get(filename, 0) + 1
+                self._changed.notify_all()
+        return bool(changed)
+
+    def version(self, filename):
+        """return the version of the doc, which is increased when it is changed"""
+        with self._changed:
+            return self._versions.get(filename, 0)
+
+    def wait(self, filename, version, timeout=None):
+        """wait until the version of the doc is changed, and return the current version"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._versions.get(filename, 0) != version,
+                                   timeout)
+            return self._versions.get(filename, 0)
+
+    def handler(self):
+        server = self
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kwargs):
+                super(Handler, self).__init__(*args, directory=server.folder, **kwargs)
+
+            def log_message(self, *args):
+                if server.verbose:
+                    super(Handler, self).log_message(*args)
+
+            def do_HEAD(self):
+                if server.hidden(self.path):
+                    self.send_error(404)
+                    return
+                super(Handler, self).do_HEAD()
+
+            def do_GET(self):
+                if server.hidden(self.path):
+                    self.send_error(404)
+                    return
+                url = urllib.parse.urlsplit(self.path)
+                if url.path == server.events_path:
+                    filename = server.source(urllib.parse.unquote(url.query))
+                    if filename is None:
+                        self.send_error(404)
+                        return
+                    self.send_events(filename)
+                    return
+                filename = server.source(self.path)
+                if filename is None:
+                    super(Handler, self).do_GET()
+                    return
+                try:
+                    html = server.render(filename)
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    self.send_error(500, 'failed to generate "%s"' % self.path)
+                    return
+                # the reload script is added after the other scripts in
+                # header (e.g., header:bsmdoc_js)
+                html = html.replace('</head>', server.reload_script + '\n</head>', 1)
+                data = html.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_events(self, filename):
+                # server-sent events to reload the page of the doc
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                version = server.version(filename)
+                try:
+                    while True:
+                        current = server.wait(filename, version, 15)
+                        if current != version:
+                            self.wfile.write(b'data: reload\n\n')
+                            version = current
+                        else:
+                            self.wfile.write(b': keep-alive\n\n')
+                        self.wfile.flush()
+                except (IOError, OSError):
+                    pass
+
+        return Handler
+
+    def create(self, host='127.0.0.1', port=8000):
+        """create the http server"""
+        httpd = http.server.ThreadingHTTPServer((host, port), self.handler())
+        httpd.daemon_threads = True
+        return httpd
+
+    def run(self, host='127.0.0.1', port=8000, interval=0.5):
+        """serve the folder until interrupted"""
+        httpd = self.create(host, port)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        _bsmdoc_info('serving "%s" at http://%s:%d/, press Ctrl+C to stop' %
+                     (self.folder, host, httpd.server_address[1]))
+        try:
+            while True:
+                time.sleep(interval)
+                self.poll()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
@@ -1,8 +1,64 @@
+import io
+import gzip
+import os
 import sys
+import contextlib
+import time
+import shutil
+import tempfile
+import threading
+import urllib.request
+import urllib.error
 import logging
 import inspect
 import unittest
-from bsmdoc import BDoc
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from bsmdoc import BDoc, BRender, BFunction, BManifest, BWatch, BServer, BCache, BConfig, BGzip
+
+
+def setUpModule():
+    # do not write the cache (e.g., highlight, parser tables) to the user folder
+    global _cache_env
+    path = tempfile.mkdtemp()
+    _cache_env = mock.patch.dict(os.environ, {'BSMDOC_CACHE_DIR': path})
+    _cache_env.start()
+
+
+def tearDownModule():
+    path = os.environ['BSMDOC_CACHE_DIR']
+    _cache_env.stop()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class _TempDir(object):
+    """temporary folder for the files used by the test, removed on exit"""
+    def __init__(self, mtime=None):
+        # the mtime of the written files, e.g., 0 to make sure it is changed
+        self.mtime = mtime
+        self.path = None
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def join(self, *paths):
+        return os.path.join(self.path, *paths)
+
+    def write(self, filename, text):
+        filename = self.join(filename)
+        with open(filename, 'wb' if isinstance(text, bytes) else 'w') as fp:
+            fp.write(text)
+        if self.mtime is not None:
+            os.utime(filename, (self.mtime, self.mtime))
+        return filename
+
+    def read(self, filename):
+        with open(self.join(filename)) as fp:
+            return fp.read()
 
 
 def log_info(msg):
@@ -21,6 +77,11 @@ class TestBsmdoc(unittest.TestCase):
         doc = BDoc()
         result = doc.parse_string(src)
         self.assertEqual(result, out)
+        # single pass and tree mode shall generate the same output
+        for kwargs in [{'single_pass': True}, {'tree': True}]:
+            doc = BDoc(**kwargs)
+            result = doc.parse_string(src)
+            self.assertEqual(result, out)
 
     def test_helloworld(self):
         output = '<h1>hello world</h1>\n'
@@ -28,6 +89,603 @@ class TestBsmdoc(unittest.TestCase):
         result = doc.parse('./docs/helloworld.bsmdoc')
         self.assertEqual(result, output)
 
+    def test_parser_tables(self):
+        # the parser tables are shared, each instance shall still be bound to
+        # its own methods
+        text = r'''{!div|myclass||bsmdoc!}'''
+        output = '<div class="myclass">\nbsmdoc\n</div>\n'
+        doc1, doc2 = BDoc(), BDoc()
+        self.assertIsNot(doc1.parser.lexer, doc2.parser.lexer)
+        self.assertEqual(doc1.parse_string(text), output)
+        self.assertEqual(doc2.parse_string(text), output)
+        self.assertEqual(doc1.parser.html, output)
+
+    def test_single_pass(self):
+        text = r'''
+                \config{heading_numbering|True}
+                \config{image_numbering|True}
+                = heading \ref{img-b} \label{sec-a}
+                see [#img-b], [#sec-a|heading], \ref{sec-b} \ref{eq-a} \cite{ref-b}
+                {!image||
+                    \label{img-a}
+                    a.png
+                !}
+                == heading \label{sec-b}
+                \cite{ref-a} \cite{hide|ref-c} \cite{ref-b}\footnote{\ref{img-b}}
+                {!image||
+                    \caption{\ref{img-a}}
+                    \label{img-b}
+                    b.png
+                !}
+                \reference{ref-a|reference a}
+                \reference{ref-b|reference b \ref{sec-a}}
+                \reference{ref-c|reference c}
+                '''
+        for txt, scan in [(text, 1), (text + r'\cite{missing} ', 2)]:
+            doc = BDoc()
+            output = doc.parse_string(_T(txt))
+            doc2 = BDoc(single_pass=True)
+            self.assertEqual(doc2.parse_string(_T(txt)), output)
+            # fall back to the 2nd scan for the citation to the undefined
+            # reference, as the empty output may change the layout
+            self.assertEqual(doc2.parser.config.get_scan(), scan)
+            self.assertEqual(doc2.parser.contents, doc.parser.contents)
+            self.assertEqual(doc2.parser.config.cited, doc.parser.config.cited)
+            self.assertEqual(doc2.parser.config.footnotes, doc.parser.config.footnotes)
+
+    def test_tree(self):
+        text = r'''
+                = heading
+                {!div|myclass||
+                $$f=ma$$
+                !}
+                {{
+                 a | b ||-
+                }}
+                '''
+        doc = BDoc(tree=True)
+        html = doc.parse_string(_T(text))
+        root = doc.parser.root
+        self.assertEqual([type(n).__name__ for n in root.children],
+                         ['BHeading', 'BBlock', 'BParagraph', 'BTable', 'BParagraph'])
+        self.assertEqual(root.children[0].level, '=')
+        self.assertIn("BEquation('f=ma', False", repr(root.children[1]))
+        # render the tree again
+        self.assertEqual(BRender(doc.parser).render(root), html)
+
+        # the included file is generated by the earlier block
+        text = r'''
+                {!exec||{%
+                with open('sub.bsmdoc', 'w') as f:
+                    f.write('= sub\n')
+                %}!}
+                #include sub.bsmdoc
+                end
+                '''
+        with _TempDir() as tmp:
+            tmp.write('main.bsmdoc', _T(text))
+            for kwargs in [{}, {'tree': True}, {'tree': True, 'single_pass': True}]:
+                if os.path.isfile(tmp.join('sub.bsmdoc')):
+                    os.remove(tmp.join('sub.bsmdoc'))
+                doc = BDoc(**kwargs)
+                self.assertEqual(doc.parse('main.bsmdoc', path=tmp.path),
+                                 '<h1>sub</h1>\n<p>end</p>\n')
+                self.assertEqual(doc.parser.log.errors(), [])
+
+    def test_plaintext(self):
+        # the words and spaces are merged into one token
+        doc = BDoc()
+        lexer = doc.parser.lexer
+        lexer.input('a  b\t c &#x20; <d>  \\tag{b|e}  f  \n')
+        self.assertEqual([(t.type, t.value) for t in lexer],
+                         [('WORD', 'a b\t c &#x20; &lt;d&gt;'), ('SPACE', ' '),
+                          ('CMD', '\\tag'), ('BRACEL', '{'), ('WORD', 'b'),
+                          ('TCELL', '|'), ('WORD', 'e'), ('BRACER', '}'),
+                          ('SPACE', ' '), ('WORD', 'f'), ('SPACE', ' '),
+                          ('NEWLINE', '\n')])
+        text = 'a  b\t c <d>  \\tag{b|e}  f  !x %y'
+        self.run_test(text, 'a b\t c &lt;d&gt; <b>e</b> f !x %y')
+
+    def test_escape(self):
+        plain = r'a <b> \{c\} [http://x|<d>]'
+        self.run_test(plain, r'a &lt;b&gt; {c} <a href="http://x">&lt;d&gt;</a>')
+        # the doc can still override the escape function block
+        text = r'''
+                {!exec||{%
+                @BFunction('escape')
+                def my_escape(data, *args, **kwargs):
+                    return data.replace('<', '[').replace('>', ']')
+                %}!}
+                a <b> [http://x|<d>]
+                '''
+        for kwargs in [{}, {'single_pass': True}]:
+            self.assertEqual(BDoc(**kwargs).parse_string(_T(text)),
+                             '<p>a [b] <a href="http://x">[d]</a></p>\n')
+        # the overridden escape is also called for the words without '<'/'>'
+        text = r'''
+                {!exec||{%
+                @BFunction('escape')
+                def my_escape(data, *args, **kwargs):
+                    return data.replace('a', 'A')
+                %}!}
+                hello cat & dog
+                '''
+        for kwargs in [{}, {'single_pass': True}]:
+            self.assertEqual(BDoc(**kwargs).parse_string(_T(text)),
+                             '<p>hello cAt & dog</p>\n')
+        # and for each word, although the words are merged by the lexer
+        text = r'''
+                {!exec||{%
+                @BFunction('escape')
+                def my_escape(data, *args, **kwargs):
+                    return '(%s)' % data
+                %}!}
+                hello  cat & dog
+                '''
+        for kwargs in [{}, {'single_pass': True}]:
+            self.assertEqual(BDoc(**kwargs).parse_string(_T(text)),
+                             '<p>(hello) (cat) (&) (dog)</p>\n')
+        # and it is only used by that doc
+        self.run_test(plain, r'a &lt;b&gt; {c} <a href="http://x">&lt;d&gt;</a>')
+
+    def test_threads(self):
+        # the function blocks, exec code and configs defined in one doc shall
+        # not be visible to the others
+        text = r'''
+                \config{heading_numbering|True}
+                \newfun{name|doc %d}
+                {!exec||{%%
+                value = %d
+                @BFunction('mul')
+                def bsmdoc_mul(data, *args, **kwargs):
+                    return str(int(data) * value)
+                %%}!}
+                = heading \ref{sec-b}
+                \name \mul{%d} [#sec-b|link] $x^{%d}$
+                == heading \label{sec-b}
+                {{
+                 \name | \mul{2} ||-
+                }}
+                '''
+        docs = [_T(text) * 5 % ((i, ) * 4 * 5) for i in range(32)]
+        serial = [BDoc().parse_string(d) for d in docs]
+        self.assertEqual(len(set(serial)), len(docs))
+        with ThreadPoolExecutor(16) as pool:
+            for _ in range(3):
+                results = list(pool.map(lambda d: BDoc().parse_string(d), docs))
+                self.assertEqual(results, serial)
+        self.assertIsNone(BFunction.get('name'))
+        self.assertIsNone(BFunction.get('mul'))
+
+    def test_path(self):
+        # the included files are relative to the doc, instead of the current
+        # working directory
+        with _TempDir() as tmp:
+            path = tmp.path
+            tmp.write('main.bsmdoc', '#include sub.bsmdoc\n\\include{sub.bsmdoc}\n')
+            tmp.write('sub.bsmdoc', 'sub\n')
+            doc = BDoc()
+            html = doc.gen('main.bsmdoc', path=path)
+            self.assertIn('<p>sub</p>\n<p>sub</p>', html)
+            self.assertEqual(doc.output_filename, os.path.join(path, 'main.html'))
+            with open(doc.output_filename) as fp:
+                self.assertEqual(fp.read(), html)
+            self.assertEqual(doc.html_text, html)
+            # the code from the docs parsed in parallel also runs in the
+            # folder of each doc
+            folders = []
+            for i in range(8):
+                folder = 'doc%d' % i
+                os.mkdir(tmp.join(folder))
+                tmp.write(os.path.join(folder, 'data.txt'), 'data %d' % i)
+                tmp.write(os.path.join(folder, 'main.bsmdoc'),
+                          "\\eval{__import__('time').sleep(0.001) or "
+                          "open('data.txt').read()}\n" * 20)
+                folders.append(tmp.join(folder))
+            cwd = os.getcwd()
+
+            def gen(folder):
+                return BDoc().parse('main.bsmdoc', path=folder)
+            with ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(gen, folders))
+            for i, html in enumerate(results):
+                self.assertEqual(html.count('data %d' % i), 20)
+            self.assertEqual(os.getcwd(), cwd)
+
+    def test_page(self):
+        # the body is inserted to body:content as it is (no '%' escaping)
+        with _TempDir() as tmp:
+            path = tmp.path
+            tmp.write('main.bsmdoc', '{!config||{%\n[body]\ncontent = <main>%(article_content)s'
+                                     '</main>\n%}!}\n100% done\n')
+            doc = BDoc()
+            html = doc.gen('main.bsmdoc', path=path, output=False)
+            self.assertIn('<main><p>100% done</p></main>', html)
+            self.assertEqual(doc.html_body, '<p>100% done</p>\n')
+
+    def test_output(self):
+        # the html file is not written again if it is not changed
+        with _TempDir() as tmp, mock.patch.dict(os.environ, {'SOURCE_DATE_EPOCH': '1500000000'}):
+            path = tmp.path
+            filename = tmp.write('main.bsmdoc', 'hello\n')
+            os.utime(filename, (1600000000, 1600000000))
+            doc = BDoc()
+            doc.gen('main.bsmdoc', path=path)
+            output = doc.output_filename
+            self.assertTrue(doc.output_changed)
+            # the updated time is not later than SOURCE_DATE_EPOCH
+            self.assertEqual(doc.cfg['updated'], '2017-07-14 02:40:00 UTC')
+            os.utime(output, (0, 0))
+            doc = BDoc()
+            doc.gen('main.bsmdoc', path=path)
+            self.assertFalse(doc.output_changed)
+            self.assertEqual(os.path.getmtime(output), 0)
+            tmp.write('main.bsmdoc', 'world\n')
+            doc.gen('main.bsmdoc', path=path)
+            self.assertTrue(doc.output_changed)
+            with open(output) as fp:
+                self.assertIn('<p>world</p>', fp.read())
+            self.assertEqual(sorted(os.listdir(path)), ['main.bsmdoc', 'main.html'])
+
+    def test_minify(self):
+        text = r'''
+                = heading
+                text  \tag{b|bold} $x$
+                $$
+                x >
+                 < y
+                $$
+                {{
+                 a | b ||-
+                }}
+                {!highlight|python||{%
+                if x:
+                    return  x
+                %}!}
+                {%
+                <div>
+                  <div>raw</div>
+                </div>
+                %}
+                {!div|box||
+                {%
+                <p>
+                  nested
+                </p>
+                %}
+                !}
+                a
+
+                b
+
+                {%<p>a</p>
+                <p>b</p>%}
+                '''
+        with _TempDir() as tmp:
+            path = tmp.path
+            tmp.write('main.bsmdoc', _T(text))
+            html = BDoc().gen('main.bsmdoc', path=path, output=False)
+            doc = BDoc()
+            doc.minify = True
+            minified = doc.gen('main.bsmdoc', path=path, output=False)
+            self.assertEqual(len(html) - len(minified), doc.minify_saved)
+            self.assertGreater(doc.minify_saved, 0)
+            self.assertIn('<head><meta charset="UTF-8">', minified)
+            self.assertIn('<h1>heading</h1><p>text <b>bold</b> \\(x\\)</p>'
+                          '<div class="mathjax">\n$$\nx &gt;\n &lt; y\n$$\n</div><table>',
+                          minified)
+            self.assertIn('<tr><td>a</td><td>b</td></tr>', minified)
+            # pre (pygments) and raw block are preserved
+            self.assertIn('return</span>  <span', minified)
+            self.assertIn('</pre></div><div>\n  <div>raw</div>\n</div><div class="box">',
+                          minified)
+            self.assertEqual(minified.count('<pre>'), html.count('<pre>'))
+            # the raw block in the function block, and the one with the same
+            # text as the html before it
+            self.assertIn('<div class="box"><p>\n  nested\n</p></div>', minified)
+            self.assertIn('<p>a</p><p>b</p><p>a</p>\n<p>b</p>', minified)
+            # the marks of the raw blocks are removed
+            self.assertNotIn('\ue002', html)
+            self.assertNotIn('\ue002', minified)
+
+    def test_gzip(self):
+        with _TempDir() as tmp:
+            path = tmp.path
+            tmp.write('main.bsmdoc', 'hello\n')
+            output = tmp.join('main.html')
+            compress = BGzip(6)
+            BDoc().gen('main.bsmdoc', path=path)
+            compress.submit(output)
+            self.assertEqual(compress.wait(), 0)
+            with gzip.open(output + '.gz', 'rb') as fp, open(output, 'rb') as fp2:
+                self.assertEqual(fp.read(), fp2.read())
+            self.assertEqual(os.stat(output + '.gz').st_mtime_ns, os.stat(output).st_mtime_ns)
+            # the html is not changed, so is the .gz file
+            BDoc().gen('main.bsmdoc', path=path)
+            compress.submit(output)
+            tmp.write('main.bsmdoc', 'world\n')
+            BDoc().gen('main.bsmdoc', path=path)
+            compress.submit(output)
+            compress.submit(os.path.join(path, 'missing.html'))
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(compress.close(), 1)
+            self.assertEqual((compress.compressed, compress.skipped), (2, 1))
+            with gzip.open(output + '.gz', 'rt') as fp:
+                self.assertIn('<p>world</p>', fp.read())
+
+    def test_readfile(self):
+        with _TempDir() as tmp:
+            path = tmp.path
+            filename = tmp.write('main.bsmdoc', 'café 中文\r\n'.encode('utf-8'))
+            doc = BDoc()
+            self.assertEqual(doc.parse('main.bsmdoc', path=path),
+                             '<p>café &#x4e2d;&#x6587;</p>\n')
+            self.assertIn(filename, doc.parser.dependencies)
+            # the file is changed, and the cached text shall not be used
+            tmp.write('main.bsmdoc', '测试\n'.encode('gbk'))
+            self.assertEqual(doc.parse('main.bsmdoc', encoding='gbk', path=path),
+                             '<p>&#x6d4b;&#x8bd5;</p>\n')
+
+    def test_include_tokens(self):
+        # the included file is lexed once, and the tokens are replayed
+        with _TempDir() as tmp:
+            path = tmp.path
+            files = {'main.bsmdoc': '#include head.bsmdoc\n{{\n#include row.bsmdoc\n}}\n'
+                                    '#include open.bsmdoc\n!}\n#include head.bsmdoc\n',
+                     'head.bsmdoc': '= heading\n$$\nf=ma\n$$\ntext $x$ <b> [#sec|link]\n',
+                     'row.bsmdoc': ' a | b ||-\n',
+                     'open.bsmdoc': '{!div|myclass||\nopen\n'}
+            for filename, text in files.items():
+                tmp.write(filename, text)
+            doc = BDoc()
+            doc.parser.include_tokens = False
+            html = doc.parse('main.bsmdoc', path=path)
+            for _ in range(2):
+                doc = BDoc()
+                self.assertEqual(doc.parse('main.bsmdoc', path=path), html)
+            # the file is changed
+            tmp.write('head.bsmdoc', '= heading \\label{sec}\n')
+            doc = BDoc()
+            self.assertEqual(doc.parse('main.bsmdoc', path=path).count('<h1 id="sec">'), 2)
+
+    def test_manifest(self):
+        with _TempDir() as tmp:
+            path = tmp.path
+
+            def gen():
+                doc = BDoc()
+                doc.gen('main.bsmdoc', path=path)
+                manifest.save(doc)
+
+            tmp.write('main.bsmdoc', '#include sub.bsmdoc\n\\include{new.bsmdoc}\n')
+            tmp.write('sub.bsmdoc', 'sub\n')
+            manifest = BManifest('main.bsmdoc', path)
+            self.assertEqual(manifest.outdated(), 'no manifest')
+            gen()
+            self.assertEqual(manifest.outdated(), '')
+            tmp.write('sub.bsmdoc', 'sub2\n')
+            self.assertEqual(manifest.outdated(), '"sub.bsmdoc" is changed')
+            gen()
+            tmp.write('new.bsmdoc', 'new\n')
+            self.assertEqual(manifest.outdated(), '"new.bsmdoc" is created')
+            gen()
+            self.assertEqual(manifest.outdated(), '')
+            os.remove(os.path.join(path, 'main.html'))
+            self.assertIn('is missing', manifest.outdated())
+            # the state can't be saved, and the doc shall be generated again
+            doc = BDoc()
+            doc.gen('main.bsmdoc', path=path)
+            doc.page_state['value'] = object()
+            with contextlib.redirect_stdout(io.StringIO()):
+                manifest.save(doc)
+            self.assertEqual(manifest.outdated(), 'no manifest')
+            self.assertEqual(os.listdir(tmp.join('.bsmdoc')), ['main.bsmdoc.page.json'])
+
+    def test_rewrap(self):
+        # the page is assembled again with the new template, without parsing
+        # the doc
+        with _TempDir() as tmp:
+            path = tmp.path
+
+            def gen():
+                doc = BDoc()
+                doc.gen('main.bsmdoc', path=path)
+                manifest.save(doc)
+                return doc.html_text
+
+            tmp.write('theme.cfg', '[footer]\ncontent = footer 1\n')
+            tmp.write('main.bsmdoc', _T(r'''
+                \config{bsmdoc_conf|theme.cfg}
+                \config{css|extra.css|add}
+                \config{doctitle|title}
+                \config{show_table_of_contents|True}
+                = heading \label{sec-a}
+                see \ref{sec-a}\footnote{note}, \cite{ref-a}
+                \reference{ref-a|reference a}
+                '''))
+            manifest = BManifest('main.bsmdoc', path)
+            gen()
+            tmp.write('theme.cfg',
+                      '[footer]\ncontent = footer 2\n[header]\ncontent = <!-- head -->\n')
+            self.assertEqual(manifest.outdated(), '"theme.cfg" is changed')
+            self.assertTrue(manifest.rewrap)
+            doc = BDoc()
+            html = doc.rewrap(manifest.load_page(), 'main.bsmdoc', path=path, output=False)
+            self.assertIn('footer 2', html)
+            self.assertIn('<!-- head -->', html)
+            self.assertEqual(html, gen())
+            # the config file changes the non-template configurations
+            tmp.write('theme.cfg', '[DEFAULT]\nheading_numbering = True\n')
+            self.assertEqual(manifest.outdated(), '"theme.cfg" is changed')
+            self.assertIsNone(doc.rewrap(manifest.load_page(), 'main.bsmdoc', path=path))
+            gen()
+            # the function blocks defined by the doc are not saved
+            tmp.write('main.bsmdoc', '\\config{bsmdoc_conf|theme.cfg}\n\\newfun{name|doc}\n')
+            gen()
+            tmp.write('theme.cfg', '[footer]\ncontent = footer 3\n')
+            self.assertTrue(manifest.outdated())
+            self.assertIsNone(doc.rewrap(manifest.load_page(), 'main.bsmdoc', path=path))
+
+    def test_watch(self):
+        # make sure the mtime is changed
+        with _TempDir(mtime=0) as tmp:
+            path = tmp.path
+            main = os.path.join(path, 'main.bsmdoc')
+            tmp.write('main.bsmdoc', '#include sub.bsmdoc\n')
+            tmp.write('sub.bsmdoc', 'sub\n')
+            tmp.write('other.bsmdoc', 'other\n')
+            watch = BWatch([main, os.path.join(path, 'other.bsmdoc')])
+            for f in watch.files:
+                self.assertEqual(watch.build(f), 'no manifest')
+            doc = watch.docs[main]
+            self.assertEqual(watch.step(), ([], []))
+            tmp.write('sub.bsmdoc', 'sub2\n')
+            self.assertEqual(watch.step(), ([main], []))
+            # the BDoc is reused
+            self.assertIs(watch.docs[main], doc)
+            self.assertIn('<p>sub2</p>', tmp.read('main.html'))
+
+    def test_serve(self):
+        with _TempDir(mtime=0) as tmp:
+            path = tmp.path
+            tmp.write('index.bsmdoc', '#include sub.bsmdoc\n')
+            tmp.write('sub.bsmdoc', 'sub\n')
+            server = BServer(path)
+            httpd = server.create(port=0)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:%d/' % httpd.server_address[1]
+
+            def get(page=''):
+                with urllib.request.urlopen(url + page) as r:
+                    return r.read().decode('utf-8')
+
+            try:
+                html = get()
+                self.assertIn('<p>sub</p>', html)
+                self.assertIn(BServer.reload_script, html)
+                self.assertEqual(get('index.html'), html)
+                self.assertEqual((server.hits, server.misses), (1, 1))
+                self.assertEqual(get('sub.bsmdoc'), 'sub\n')
+                self.assertFalse(server.poll())
+                tmp.write('sub.bsmdoc', 'sub2\n')
+                index = server.source('/index.html')
+                version = server.version(index)
+                self.assertTrue(server.poll())
+                self.assertEqual(server.wait(index, version, 0), version + 1)
+                self.assertIn('<p>sub2</p>', get())
+                self.assertEqual((server.hits, server.misses), (1, 2))
+                # only the page of the changed doc is reloaded
+                tmp.write('other.bsmdoc', 'other\n')
+                self.assertIn('<p>other</p>', get('other.html'))
+                other = server.source('/other.html')
+                tmp.write('other.bsmdoc', 'other2\n')
+                self.assertTrue(server.poll())
+                self.assertEqual(server.version(other), 1)
+                self.assertEqual(server.version(index), version + 1)
+                # the html is not cached if its inputs are changed while it
+                # is generated
+                tmp.write('stale.bsmdoc', _T(r'''
+                    #include sub.bsmdoc
+                    {!exec||{%
+                    open('sub.bsmdoc', 'w').write('sub3\n')
+                    %}!}
+                    '''))
+                self.assertIn('<p>sub2</p>', get('stale.html'))
+                self.assertTrue(server.poll())
+                self.assertIn('<p>sub3</p>', get('stale.html'))
+                hits = server.hits
+                self.assertIn('<p>sub3</p>', get('stale.html'))
+                self.assertEqual(server.hits, hits + 1)
+                # the manifest folder is not served
+                os.mkdir(tmp.join('.bsmdoc'))
+                tmp.write('.bsmdoc/index.bsmdoc.json', '{}')
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    get('.bsmdoc/index.bsmdoc.json')
+                self.assertEqual(e.exception.code, 404)
+                # only the docs in the folder are generated
+                os.mkdir(path + '-private')
+                try:
+                    with open(os.path.join(path + '-private', 'x.bsmdoc'), 'w') as fp:
+                        fp.write('private\n')
+                    name = os.path.basename(path)
+                    self.assertIsNone(server.source('/../%s-private/x.html' % name))
+                    self.assertEqual(server.source('/index.html'),
+                                     os.path.join(server.folder, 'index.bsmdoc'))
+                finally:
+                    shutil.rmtree(path + '-private')
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+
+    def test_config(self):
+        cfg = BConfig()
+        cfg.load('[DEFAULT]\nName = bsmdoc\n[sec]\nTitle = %(NAME)s 100%%\nnum = 1\n'
+                 "items = ['a', 'b']\n")
+        self.assertEqual(cfg['sec:title'], 'bsmdoc 100%')
+        self.assertEqual(cfg['sec:NUM'], 1)
+        # fall back to DEFAULT section
+        self.assertEqual(cfg['sec:name'], 'bsmdoc')
+        self.assertEqual(cfg['missing:name'], '')
+        # the interpolation is done when the value is read
+        cfg['name'] = 'doc'
+        self.assertEqual(cfg['sec:title'], 'doc 100%')
+        items = cfg['sec:items']
+        items.append('c')
+        self.assertEqual(cfg['sec:items'], ['a', 'b'])
+        cfg['new:flag'] = 'True'
+        self.assertIs(cfg['new:flag'], True)
+        with self.assertRaises(ValueError):
+            cfg['title'] = '100%'
+        cfg['ANCHOR:Sec-A'] = '1.10'
+        self.assertEqual(cfg['ANCHOR:sec-a'], '1.10')
+        self.assertEqual(cfg.anchors, {'sec-a': '1.10'})
+
+        # the default configurations are parsed once, and shall not be
+        # changed by the doc
+        txt = '[header]\ncontent = <meta>\n'
+        self.assertIs(BConfig._parse_ini(txt), BConfig._parse_ini(txt))
+        cfg.reset_options()
+        cfg.load(txt)
+        cfg['title'] = 'bsmdoc'
+        cfg['header:bsmdoc_css'] = ['a.css']
+        self.assertEqual(cfg['header:content'], '<meta>')
+        cfg2 = BConfig()
+        cfg2.reset_options()
+        self.assertEqual(cfg2['title'], '')
+        self.assertEqual(cfg2['header:content'], '')
+        self.assertEqual(cfg2['header:bsmdoc_css'], ['css/bsmdoc.css'])
+        self.assertEqual(cfg2['doctitle'], '')
+
+    def test_log(self):
+        # the warning from each scan is only shown once
+        text = r'''
+                \ref{sec-end}
+                \undefined{a}
+                \undefined{a}
+                = end \label{sec-end}
+                '''
+        doc = BDoc()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            doc.parse_string(_T(text))
+        self.assertEqual(doc.parser.config.get_scan(), 2)
+        self.assertEqual(output.getvalue().count('undefined function block'), 2)
+        self.assertEqual([(m.level, m.lineno) for m in doc.parser.log.warnings()],
+                         [('Warning', 2), ('Warning', 3)])
+
+        # the deferred warnings are shown by flush
+        doc = BDoc()
+        doc.parser.log.deferred = True
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            doc.parse_string(_T(text))
+            self.assertEqual(output.getvalue(), '')
+            doc.parser.log.flush()
+        self.assertEqual(output.getvalue(),
+                         '<input>   2: Warning undefined function block "undefined".\n'
+                         '<input>   3: Warning undefined function block "undefined".\n')
+        self.assertEqual(doc.parser.log.messages, [])
+
     def test_newfun(self):
         text = r'''\newfun{bsmdoc|bsmdoc}
                    \bsmdoc
@@ -51,6 +709,47 @@ class TestBsmdoc(unittest.TestCase):
                   '''
         self.run_test(_T(text), _T(output))
 
+    def test_function(self):
+        # the internal calls (e.g., \tag for the table cells) shall call the
+        # function block overridden by the doc
+        text = r'''
+                {!exec||{%
+                @BFunction('tag')
+                def my_tag(data, *args, **kwargs):
+                    return '[%s:%s]' % (args[0], data)
+                %}!}
+                {{
+                 a | b ||-
+                }}
+                '''
+        for kwargs in [{}, {'single_pass': True}, {'tree': True}]:
+            self.assertEqual(BDoc(**kwargs).parse_string(_T(text)),
+                             '[table:[tbody:[tr:[td:a][td:b]]]]')
+        self.assertEqual(BFunction.call('tag', 'a', 'b'), '<b>a</b>')
+        with self.assertRaises(AttributeError):
+            BFunction.call('missing', 'a')
+
+        # the parsed args are cached, and shall not be changed by the caller
+        @BFunction('args')
+        def bsmdoc_args(data, *args, **kwargs):
+            kwargs['fun_args'].append('x')
+            kwargs['fun_kwargs']['items'].append('x')
+            return repr((kwargs['fun_args'], kwargs['fun_kwargs']))
+        try:
+            for _ in range(2):
+                self.assertEqual(BFunction.call('args', '', 'a', '1', 'items=[1]'),
+                                 "(['a', 1, 'x'], {'items': [1, 'x']})")
+        finally:
+            BFunction._interfaces.pop('args')
+
+        # the scan info of the current parser
+        self.assertEqual(BFunction.scan_info, {})
+        text = 'a\n\\eval{BFunction.scan_info.get("lineno")}\n'
+        self.assertEqual(BDoc().parse_string(text), '<p>a\n2</p>\n')
+        # and it is not changed by the function block
+        text = '\\eval{"fun_args" in BFunction.scan_info}\n'
+        self.assertEqual(BDoc().parse_string(text), '<p>False</p>\n')
+
     def test_image(self):
         text = r'''\image{bsmdoc.png}'''
         output = '<p><img src="bsmdoc.png" alt="bsmdoc.png"></p>\n'
@@ -70,6 +769,31 @@ class TestBsmdoc(unittest.TestCase):
 
         self.run_test(_T(text), _T(output))
 
+        # the label/caption in the block shall not leak to the enclosing or
+        # the following blocks
+        text = r'''
+                \config{image_numbering|True}
+                {!div|outer||
+                    {!image||
+                        \caption{inner}
+                        \label{img-inner}
+                        a.png
+                    !}
+                    {!image||
+                        b.png
+                    !}
+                !}'''
+        output = r'''<div class="outer">
+                     <figure id="img-inner" class="figure">
+                     <img src="a.png" alt="a.png">
+                     <figcaption class="caption"><span class="tag">Fig.1.</span> inner</figcaption>
+                     </figure>
+                     <figure class="figure">
+                     <img src="b.png" alt="b.png">
+                     </figure>
+                     </div>'''
+        self.run_test(_T(text), _T(output))
+
     def test_highlight(self):
         text = r"""{!highlight|C++|linenos=table|hl_lines=(6,)||{%
                    #include <iostream>
@@ -102,6 +826,91 @@ class TestBsmdoc(unittest.TestCase):
                   '''
         self.run_test(_T(text), _T(output, False))
 
+    def test_cache(self):
+        with _TempDir() as tmp, mock.patch.dict(os.environ, {'BSMDOC_CACHE_DIR': tmp.path}):
+            path = tmp.path
+            cache = BCache('test', size=2, disk_size=10)
+            keys = [BCache.key('code', i) for i in range(20)]
+            self.assertEqual(len(set(keys)), 20)
+            self.assertIsNone(cache.get(keys[0]))
+            for i, k in enumerate(keys):
+                cache.set(k, 'value %d' % i)
+            self.assertEqual(len(cache._cache), 2)
+            self.assertLessEqual(len(os.listdir(os.path.join(path, 'test'))), 10)
+            # load from disk
+            cache = BCache('test', size=2, disk_size=10)
+            self.assertEqual(cache.get(keys[-1]), 'value 19')
+            self.assertEqual(cache.get(keys[-1]), 'value 19')
+            self.assertIsNone(cache.get(keys[0]))
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_exec(self):
+        with _TempDir() as tmp, mock.patch.dict(os.environ, {'BSMDOC_CACHE_DIR': tmp.path}):
+            path = tmp.path
+            text = r'''
+                    {!exec|cache|inputs=in.txt|outputs=out.txt||{%
+                    with open('out.txt', 'w') as fp:
+                        fp.write(open('in.txt').read())
+                    with open('runs.txt', 'a') as fp:
+                        fp.write('x')
+                    %}!}
+                    \eval{cache|inputs=in.txt|open('in.txt').read()}
+                    '''
+            tmp.write('doc.bsmdoc', _T(text))
+            tmp.write('in.txt', 'a')
+            runs = []
+            for update in [None, 'in.txt', None, 'out.txt']:
+                if update == 'in.txt':
+                    tmp.write('in.txt', 'b')
+                elif update == 'out.txt':
+                    os.remove(os.path.join(path, 'out.txt'))
+                html = BDoc().gen('doc.bsmdoc', output=False, path=path)
+                self.assertIn('<p>%s</p>' % tmp.read('in.txt'), html)
+                self.assertEqual(tmp.read('out.txt'), tmp.read('in.txt'))
+                runs.append(tmp.read('runs.txt'))
+            self.assertEqual(runs, ['x', 'xx', 'xx', 'xxx'])
+
+            # the cached exec block still defines its variables, and the
+            # cached eval block depends on the variables it reads
+            text = r'''
+                    {!exec||{%
+                    scale = SCALE
+                    %}!}
+                    {!exec|cache||{%
+                    with open('vars.txt', 'a') as fp:
+                        fp.write('x')
+                    items = [1, 2]
+                    %}!}
+                    \eval{cache|sum(items) * scale}
+                    '''
+            runs = []
+            for scale in [1, 1, 2]:
+                tmp.write('doc.bsmdoc', _T(text).replace('SCALE', str(scale)))
+                html = BDoc().gen('doc.bsmdoc', output=False, path=path)
+                self.assertIn('<p>%d</p>' % (3 * scale), html)
+                runs.append(tmp.read('vars.txt'))
+            self.assertEqual(runs, ['x', 'x', 'x'])
+
+            # run the code in another process, with the variables defined by
+            # the doc
+            text = r'''
+                    {!exec||{%
+                    import math
+                    value = 2
+                    %}!}
+                    \eval{async|math.floor(1.5) + value}
+                    \eval{async|timeout=0.5|__import__('time').sleep(30)}
+                    {!exec|async||{%
+                    open('async.txt', 'w').write('async')
+                    %}!}
+                    '''
+            tmp.write('doc.bsmdoc', _T(text))
+            start = time.time()
+            html = BDoc().gen('doc.bsmdoc', output=False, path=path)
+            self.assertLess(time.time() - start, 10)
+            self.assertIn('<p>3\n</p>', html)
+            self.assertEqual(tmp.read('async.txt'), 'async')
+
     def test_heading(self):
         text = r'''
                 = heading 1